@@ -0,0 +1,39 @@
+"""Time taken to create the tests and tasks of a run, as done by
+gcvb compute, for tests tests of one task and two validations each
+(default 100000 tests, 300000 tasks).
+
+    python benchmarks/add_tests.py [tests [by_test]]
+
+add_tests creates them in a single run, add_runs in one run per test for the
+by_test first tests, like compute --by-test. The database is created in a
+temporary directory.
+"""
+import os
+import sys
+import tempfile
+import time
+from gcvb import db
+
+def make_tests(count):
+    return [{"id" : f"t{i}", "Tasks" : [{"Validations" : [{}, {}]}]} for i in range(count)]
+
+def main(tests=100000, by_test=5000):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.set_db(os.path.join(tmp, "gcvb.db"))
+        db.create_db()
+        gcvb_id=db.new_gcvb_instance("", "", "")
+
+        test_list=make_tests(tests)
+        start=time.perf_counter()
+        run=db.add_run(gcvb_id, None)
+        db.add_tests(run, test_list, False)
+        print(f"add_tests, {tests} tests / {3*tests} tasks : {time.perf_counter()-start:.2f} s")
+
+        batches=[[t] for t in make_tests(by_test)]
+        start=time.perf_counter()
+        db.add_runs(gcvb_id, None, batches, False)
+        print(f"add_runs, {by_test} runs of one test : {time.perf_counter()-start:.2f} s")
+        db.close_connections()
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:3]])
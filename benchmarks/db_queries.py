@@ -0,0 +1,68 @@
+"""Latency of the queries of report and history on a valid table of
+runs x tests x metrics rows (default 100 x 100 x 100, 1M rows), with the
+secondary indexes of the schema and without them.
+
+    python benchmarks/db_queries.py [runs tests metrics]
+
+The database is created in a temporary directory.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from gcvb import db
+
+indexes=["test_run_name", "task_test_step", "task_status", "valid_test_step",
+         "valid_metric", "files_test_filename", "test_name"]
+
+def fill(runs, tests, metrics, seed=0):
+    """Create the current database with every test of every run having two
+       tasks, the second one recording all the metrics."""
+    rng=random.Random(seed)
+    db.create_db()
+    conn=db.get_connection()
+    conn.execute("BEGIN EXCLUSIVE")
+    gcvb_id=conn.execute("INSERT INTO gcvb(creation_date) VALUES (?)", [db.now()]).lastrowid
+    conn.executemany("INSERT INTO run(id,gcvb_id) VALUES (?,?)", [(r, gcvb_id) for r in range(1, runs+1)])
+    conn.executemany("INSERT INTO test(id,name,run_id) VALUES (?,?,?)",
+                     [(r*tests+t, f"t{t}", r) for r in range(1, runs+1) for t in range(tests)])
+    conn.executemany("INSERT INTO task(step,parent,test_id,status) VALUES (?,?,?,0)",
+                     [(s, s-1, r*tests+t) for r in range(1, runs+1) for t in range(tests) for s in (1, 2)])
+    conn.executemany("INSERT INTO valid(metric,value,test_id,task_step) VALUES (?,?,?,2)",
+                     ((f"m{m}", rng.random(), r*tests+t) for r in range(1, runs+1) for t in range(tests) for m in range(metrics)))
+    conn.commit()
+
+def timed(f, *args, repeat=5):
+    """Mean duration of f(*args) in ms, after one warm-up call."""
+    f(*args)
+    start=time.perf_counter()
+    for _ in range(repeat):
+        f(*args)
+    return (time.perf_counter()-start)/repeat*1000
+
+def measure(runs, tests, metrics):
+    run=runs//2
+    return {"retrieve_history" : timed(db.retrieve_history, "t5", "m7"),
+            "load_report_n" : timed(db.load_report_n, run),
+            "get_steps" : timed(db.get_steps, run)}
+
+def main(runs=100, tests=100, metrics=100):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.set_db(os.path.join(tmp, "gcvb.db"))
+        start=time.perf_counter()
+        fill(runs, tests, metrics)
+        print(f"{runs*tests*metrics} valid rows created in {time.perf_counter()-start:.1f} s")
+        indexed=measure(runs, tests, metrics)
+        conn=db.get_connection()
+        for index in indexes:
+            conn.execute(f"DROP INDEX IF EXISTS {index}")
+        conn.commit()
+        plain=measure(runs, tests, metrics)
+        print(f"{'query':<20}{'no index':>12}{'indexed':>12}")
+        for name in indexed:
+            print(f"{name:<20}{plain[name]:>9.2f} ms{indexed[name]:>9.2f} ms")
+        db.close_connections()
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:4]])
@@ -0,0 +1,78 @@
+"""Checks that model.evaluate_metrics gives the same distances and pass mask
+with numpy and without it, scalar and series metrics mixed, then times it
+against checking each metric with its Metric object on relative and absolute
+metrics (default 10000 rows checked, 100000 timed).
+
+    python benchmarks/evaluate_metrics.py [rows [timed_rows]]
+"""
+import math
+import random
+import sys
+import time
+from gcvb import model
+from gcvb import util
+
+def make_table(rows, seed=0, types=tuple(model.metric_types)):
+    """MetricTable of rows metrics of the given types, recorded with scalars,
+       series, NaN or not at all."""
+    rng = random.Random(seed)
+    table = model.MetricTable()
+    for row in range(rows):
+        t = types[row % len(types)]
+        series = model.metric_types[t].series
+        reference = [rng.uniform(-2, 2) for _ in range(5)] if series and t != "percentile" else rng.choice([0., rng.uniform(-2, 2)])
+        params = {"percentiles" : [10, 90], "repetitions" : 3} if t == "percentile" else None
+        table.append(f"m{row}", t, reference, rng.choice([0., 0.01, 0.1]), params)
+        kind = rng.randrange(5)
+        if kind == 0:
+            value = None
+        elif kind == 1:
+            value = math.nan
+        elif kind == 2:
+            value = [v + rng.gauss(0, 0.05) for v in (reference if isinstance(reference, list) else [reference] * 5)]
+        else:
+            value = (reference[0] if isinstance(reference, list) else reference) + rng.gauss(0, 0.05)
+        table.record(row, value)
+    return table
+
+def same(a, b):
+    return len(a) == len(b) and all(x == y or (math.isnan(x) and math.isnan(y)) for x, y in zip(a, b))
+
+def without_numpy(f, *args):
+    numpy_module = util.numpy_module
+    util.numpy_module = lambda: None
+    try:
+        return f(*args)
+    finally:
+        util.numpy_module = numpy_module
+
+def per_object(table):
+    """What validations did before evaluate_metrics : one Metric object per row."""
+    for row in range(len(table)):
+        if table.recorded[row]:
+            table.get_metric(row).within_tolerance(table.value[row])
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+def check(rows=10000):
+    table = make_table(rows)
+    default = model.evaluate_metrics(table, 0, rows)
+    fallback = without_numpy(model.evaluate_metrics, table, 0, rows)
+    assert same(default[0], fallback[0]), "distances differ"
+    assert list(default[1]) == list(fallback[1]), "pass masks differ"
+    print(f"{rows} metrics : same results with and without numpy (numpy {'found' if util.numpy_module() else 'not installed'})")
+
+def bench(rows=100000):
+    table = make_table(rows, types=("relative", "absolute"))
+    print(f"{rows} relative and absolute metrics :")
+    print(f"  per-object within_tolerance loop {timed(per_object, table):8.3f} s")
+    if util.numpy_module():
+        print(f"  evaluate_metrics, numpy          {timed(model.evaluate_metrics, table, 0, rows):8.3f} s")
+    print(f"  evaluate_metrics, without numpy  {timed(without_numpy, model.evaluate_metrics, table, 0, rows):8.3f} s")
+
+if __name__ == "__main__":
+    check(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
+    bench(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
@@ -1,4 +1,5 @@
 name = "gcvb"
 
 from .user_lib import add_metric as add_metric
+from .user_lib import add_series as add_series
 from .db import set_db as set_db
\ No newline at end of file
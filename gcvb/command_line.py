@@ -7,6 +7,7 @@ import sys
 import pprint
 import time
 import platform
+import datetime
 from . import yaml_input
 from . import template
 from . import job
@@ -17,6 +18,12 @@ from . import generate_refs
 from . import jobrunner
 from . import model
 from . import report
+from . import history
+from . import user_lib
+from . import scheduler
+from . import distributed
+from . import incremental
+from . import events
 
 def parse():
     parser = argparse.ArgumentParser(description="(G)enerate (C)ompute (V)alidate (B)enchmark",prog="gcvb")
@@ -46,6 +53,8 @@ def parse():
     parser_snippet = snippet.generate_parser(subparsers)
     parser_generate_refs = subparsers.add_parser('generate_refs', help="generate references from a base where a computation has already been executed.")
     parser_jobrunner = subparsers.add_parser("jobrunner", help="jobrunner to launch tests in parallel")
+    parser_cancel = subparsers.add_parser("cancel", help="stop a run : pending tasks are cancelled, running ones are killed by their jobrunner")
+    parser_simulate = subparsers.add_parser("simulate", help="replay a run to compare the makespan of jobrunner scheduling policies")
 
     parser_generate.add_argument('--data-root',metavar="dir",default=None)
     parser_generate.add_argument('--yaml-file', '-f', metavar="filename", default="test.yaml")
@@ -65,6 +74,7 @@ def parse():
     group.add_argument("--header", metavar="file", help="use file as header when generating job script", default=None)
     group.add_argument("--local-header", action="store_true", help="use 'local_header' defined in configuration as header when generating job script. Here, it is assumed that the header file is present in job directory at launch. When multiple benchmarks are selected, the header corresponding to the first benchmarks is considered.", default=False)
     parser_compute.add_argument("--chain", action="store_true", help="stricter dependencies between tasks and validation")
+    parser_compute.add_argument("--incremental", action="store_true", help="do not run again the tests whose commands, executables and data did not change since a successful run, their metrics and kept files are copied")
     parser_compute.add_argument("--wait-after-submitting", action="store_true", help="wait for the submitted job to complete before submitting the next one", default=False)
     parser_compute.add_argument("--with-singularity", action="store_true", help="execute all commands in job script within a Singularity container")
     group = parser_compute.add_mutually_exclusive_group()
@@ -81,21 +91,47 @@ def parse():
     parser_compute.add_argument("--started-first", action="store_true", help="already started tests are launched with a higher priority (--with-jobrunner required)")
     parser_compute.add_argument("--quiet", action="store_true", help="Hide jobrunner execution log")
     parser_compute.add_argument("--max-concurrent", metavar="jobs", type=int, help="maxium jobs that can be executed concurrently by a jobrunner (--with-jobrunner required)", default=0)
-
-    parser_db.add_argument("db_command", choices=["start_test","end_test","start_run","end_run","start_task","end_task"])
-    parser_db.add_argument("first", type=str)
-    parser_db.add_argument("second", type=str)
-    parser_db.add_argument("third", type=str)
+    parser_compute.add_argument("--compression-workers", metavar="processes", type=int, help="number of processes compressing kept files (--with-jobrunner required)", default=2)
+    parser_compute.add_argument("--policy", metavar="name", help=f"jobrunner scheduling policy ({', '.join(scheduler.policies)} or module.Class) (--with-jobrunner required)", default="cores")
+    parser_compute.add_argument("--no-binding", action="store_true", help="do not bind each job to its own cores (--with-jobrunner required)")
+    parser_compute.add_argument("--max-memory", metavar="size", help="memory available to the jobs started by a jobrunner, e.g. 64G (--with-jobrunner required)", default=None)
+    parser_compute.add_argument("--timeout-factor", metavar="factor", type=float, help="kill the jobs without timeout lasting more than factor times their median duration in previous runs (--with-jobrunner required)", default=None)
+    parser_compute.add_argument("--min-timeout", metavar="duration", type=util.parse_duration, help="lower bound of the timeouts given by --timeout-factor, e.g. 90s or 5m (default: 60s)", default=60)
+    parser_compute.add_argument("--events-socket", metavar="path", help="also send the jobrunner events to the clients of this Unix socket (--with-jobrunner required)", default=None)
+
+    parser_db.add_argument("db_command", choices=["start_test","end_test","start_run","end_run","start_task","end_task","gc","export","archive","merge"])
+    parser_db.add_argument("first", type=str, nargs="?")
+    parser_db.add_argument("second", type=str, nargs="?")
+    parser_db.add_argument("third", type=str, nargs="?")
+    parser_db.add_argument("--keep-last", metavar="N", type=int, help="archive: keep the N most recent runs", default=None)
+    parser_db.add_argument("--older-than", metavar="days", type=float, help="archive: archive runs completed more than <days> days ago", default=None)
 
     parser_generate_refs.add_argument("--gcvb-base",metavar="base_id",help="choose a specific base (default: last one created)", default=None)
     parser_generate_refs.add_argument("reference_id",help="arbitrary string to identify how the references were generated")
     parser_generate_refs.add_argument("files", help="comma-separated list of files to be copied as references")
     parser_generate_refs.add_argument("--description", help="description to be added for each reference created", default="Generated by generate_refs command.")
 
-    parser_jobrunner.add_argument("num_cores", metavar="num_cores", type=int, help="number of cores to be used")
+    parser_jobrunner.add_argument("num_cores", metavar="num_cores", type=int, nargs="?", help="number of cores to be used (not used with --serve)")
+    group = parser_jobrunner.add_mutually_exclusive_group()
+    group.add_argument("--serve", metavar="[host:]port", nargs="?", const=f"0.0.0.0:{distributed.default_port}", default=None,
+                       help=f"hand out the jobs to workers connecting to this address (default: 0.0.0.0:{distributed.default_port}). There is no authentication, only use on a trusted network.")
+    group.add_argument("--connect", metavar="host[:port]", default=None, help="run the jobs handed out by a jobrunner launched with --serve")
     parser_jobrunner.add_argument("--started-first", action="store_true", help="already started tests are launched with a higher priority")
     parser_jobrunner.add_argument("--quiet", action="store_true", help="Hide execution log")
     parser_jobrunner.add_argument("--max-concurrent", metavar="jobs", type=int, help="maxium jobs that can be executed concurrently by a jobrunner", default=0)
+    parser_jobrunner.add_argument("--compression-workers", metavar="processes", type=int, help="number of processes compressing kept files", default=2)
+    parser_jobrunner.add_argument("--policy", metavar="name", help=f"scheduling policy ({', '.join(scheduler.policies)} or module.Class)", default="cores")
+    parser_jobrunner.add_argument("--no-binding", action="store_true", help="do not bind each job to its own cores")
+    parser_jobrunner.add_argument("--max-memory", metavar="size", help="memory available to the jobs, e.g. 64G", default=None)
+    parser_jobrunner.add_argument("--timeout-factor", metavar="factor", type=float, help="kill the jobs without timeout lasting more than factor times their median duration in previous runs", default=None)
+    parser_jobrunner.add_argument("--min-timeout", metavar="duration", type=util.parse_duration, help="lower bound of the timeouts given by --timeout-factor, e.g. 90s or 5m (default: 60s)", default=60)
+    parser_jobrunner.add_argument("--events-socket", metavar="path", help="also send the events to the clients of this Unix socket", default=None)
+
+    parser_cancel.add_argument("--run-id", metavar="run_id", type=int, help="run to cancel (default: last one)", default=None)
+
+    parser_simulate.add_argument("num_cores", metavar="num_cores", type=int, help="number of cores of the simulated jobrunner")
+    parser_simulate.add_argument("--run-id", metavar="run_id", type=int, help="run to replay (default: last one)", default=None)
+    parser_simulate.add_argument("--policy", metavar="name", action="append", help="policy to simulate, can be repeated (default: all)", default=None)
 
     parser_report.add_argument("--polling", action="store_true", help="poll report until finished or timeout expiration")
     parser_report.add_argument("-f","--frequency", help="time between each check", type=float, default=10)
@@ -150,11 +186,34 @@ def get_to_gcvb_root(config):
     sys.path.append(d)
 
 def report_check_terminaison(run_id):
+    db.merge_journal()
     tests=db.get_tests(run_id)
     completed_tests=list(filter(lambda x: x["end_date"], tests))
     finished=(len(completed_tests)==len(tests))
     return completed_tests,tests,finished
 
+def report_follow_events(log, run_id, timeout):
+    """Print the progress of a run from the events of its jobrunners (see events.py)."""
+    completed_tests, tests, finished = report_check_terminaison(run_id)
+    completed = {t["name"] for t in completed_tests}
+    previous = -1
+    for e in events.follow(log, timeout):
+        if e["event"] == "job_finished" and e["end_test"]:
+            completed.add(e["test"])
+        elif e["event"] == "runner_stopped":
+            # tests may also be completed by gcvb cancel or by runners started before
+            completed_tests, tests, finished = report_check_terminaison(run_id)
+            completed.update(t["name"] for t in completed_tests)
+        if len(completed) != previous:
+            previous = len(completed)
+            now = time.strftime("%H:%M:%S %d/%m/%y")
+            eta = " ETA {:.0f}s".format(e["eta"]) if e.get("eta") is not None else ""
+            print("Tests completed : {!s}/{!s} ({!s}) - {!s}/{!s} cores in use, {!s} ready{}".format(
+                len(completed), len(tests), now, e.get("cores_in_use", 0), e.get("cores", 0), e.get("ready", 0), eta))
+            sys.stdout.flush()
+        if len(completed) == len(tests):
+            break
+
 def list_human_readable(packs):
   r = {"Packs" : []}
   for p in packs:
@@ -166,11 +225,11 @@ def list_human_readable(packs):
 def main():
     args=parse()
     db.set_db(args.db_file)
-    if args.command not in ["db","snippet"]:
+    if args.command not in ["db","snippet"] and not getattr(args, "connect", None):
         #currently db is a special command that is supposed to be invoked only internaly by gcvb.
         get_to_gcvb_root(args.config)
 
-    if not(os.path.isfile(db.database)):
+    if not(os.path.isfile(db.database)) and not getattr(args, "connect", None):
         db.create_db()
 
     #Commands
@@ -235,8 +294,9 @@ def main():
             all_batch_jobs=all_tests
             nbr_batch_jobs=len(all_batch_jobs)
 
+        batches=[]
+        job_files=[]
         for i in range(nbr_batch_jobs):
-            run_id=db.add_run(gcvb_id,config_id)
             batch_job=all_tests
 
             if(args.by_batch):
@@ -244,12 +304,24 @@ def main():
                 batch_job=[t for t in all_tests if re.match(all_batch_jobs[i], t["id"])]
             elif(args.by_test):
                 job_file=os.path.join(computation_dir,"{}.sh".format(all_batch_jobs[i]["id"]))
-                batch_job=all_batch_jobs[i]
+                batch_job=[all_batch_jobs[i]]
             else:
-                job_file=os.path.join(computation_dir,"job.sh")            
-
-            db.add_tests(run_id, batch_job, args.chain)
-
+                job_file=os.path.join(computation_dir,"job.sh")
+            batches.append(batch_job)
+            job_files.append(job_file)
+
+        # Every run and test is created in a single transaction
+        run_ids=db.add_runs(gcvb_id, config_id, batches, args.chain)
+
+        for run_id, batch_job, job_file in zip(run_ids, batches, job_files):
+            if args.incremental and not(args.validate_only):
+                copied=set(incremental.reuse_unchanged(run_id, config, a, computation_dir))
+                print("{} unchanged test(s) copied from previous runs.".format(len(copied)))
+                batch_job=[t for t in batch_job if t["id"] not in copied]
+                if not(batch_job):
+                    db.start_run(run_id)
+                    db.end_run(run_id)
+                    continue
             data_root=a["data_root"]
             job.write_script(
                 batch_job, config, data_root, gcvb_id, run_id,
@@ -262,20 +334,61 @@ def main():
             if not(args.dry_run) and not(args.with_jobrunner):
                 job.launch(job_file,config,args.validate_only,args.wait_after_submitting)
             if (args.with_jobrunner):
-                j=jobrunner.JobRunner(args.with_jobrunner, run_id, config, args.started_first, args.max_concurrent, args.verbose)
+                j=jobrunner.JobRunner(args.with_jobrunner, run_id, config, args.started_first, args.max_concurrent, not args.quiet,
+                                      compression_workers=args.compression_workers, policy=scheduler.get_policy(args.policy),
+                                      binding=not args.no_binding, max_memory=args.max_memory,
+                                      timeout_factor=args.timeout_factor, min_timeout=args.min_timeout,
+                                      events_socket=args.events_socket)
                 j.run()
 
     if args.command=="jobrunner":
+        if args.serve is None and args.num_cores is None:
+            raise ValueError("jobrunner requires num_cores (unless --serve is used).")
+        if args.connect:
+            # workers only need the results directory, the database is left to the coordinator.
+            w=distributed.Worker(distributed.parse_address(args.connect), args.num_cores, not args.quiet,
+                                 binding=not args.no_binding, max_memory=args.max_memory)
+            w.run()
+            return
         run_id,gcvb_id=db.get_last_run() #run chosen should be modifiable
         config=util.open_yaml(args.config)
+        if args.serve:
+            c=distributed.Coordinator(run_id, config, args.started_first, not args.quiet,
+                                      distributed.parse_address(args.serve, "0.0.0.0"),
+                                      compression_workers=args.compression_workers, policy=scheduler.get_policy(args.policy),
+                                      timeout_factor=args.timeout_factor, min_timeout=args.min_timeout,
+                                      events_socket=args.events_socket)
+            c.run()
+            return
         num_cores=args.num_cores
-        j=jobrunner.JobRunner(num_cores, run_id, config, args.started_first, args.max_concurrent, not args.quiet)
+        j=jobrunner.JobRunner(num_cores, run_id, config, args.started_first, args.max_concurrent, not args.quiet,
+                              compression_workers=args.compression_workers, policy=scheduler.get_policy(args.policy),
+                              binding=not args.no_binding, max_memory=args.max_memory,
+                              timeout_factor=args.timeout_factor, min_timeout=args.min_timeout,
+                              events_socket=args.events_socket)
         j.run()
 
+    if args.command=="cancel":
+        db.merge_journal()
+        run_id=args.run_id if args.run_id is not None else db.get_last_run()[0]
+        running=db.cancel_run(run_id)
+        print(f"Run {run_id} cancelled, {running} running task(s) will be killed by their jobrunner.")
+
+    if args.command=="simulate":
+        db.merge_journal()
+        run_id=args.run_id if args.run_id is not None else db.get_last_run()[0]
+        if db.get_run_infos(run_id) is None:
+            print(f"Run {run_id} does not exist in gcvb.db (it may have been archived).", file=sys.stderr)
+            sys.exit(1)
+        config=util.open_yaml(args.config)
+        for name, makespan in scheduler.simulate(run_id, args.num_cores, config, args.policy).items():
+            print(f"{name:<16}{makespan:10.2f} s")
+
     if args.command=="db":
         if args.db_command=="start_run":
             db.start_run(args.first)
         if args.db_command=="end_run":
+            db.merge_journal()
             db.end_run(args.first)
         if args.db_command=="start_test":
             db.set_db("../../../gcvb.db")
@@ -292,9 +405,26 @@ def main():
             db.start_task(args.first, args.second)
         if args.db_command=="end_task":
             db.set_db("../../../gcvb.db")
-            db.end_task(args.first, args.second, args.third)
+            spool=user_lib.spool_path(args.second)
+            db.end_task(args.first, args.second, args.third, user_lib.read_spool(spool))
+            if os.path.exists(spool):
+                os.remove(spool)
+        if args.db_command=="merge":
+            print(f"{db.merge_journal()} journaled updates applied.")
+        if args.db_command=="gc":
+            print(f"{db.gc()} unused blobs deleted.")
+        if args.db_command=="export":
+            # gcvb db export <file.csv|file.parquet> [since_run]
+            count=history.export(args.first, args.filter_by_test_id, int(args.second) if args.second else 0)
+            print(f"{count} values exported to {args.first}.")
+        if args.db_command=="archive":
+            if args.keep_last is None and args.older_than is None:
+                raise ValueError("archive requires --keep-last and/or --older-than.")
+            older_than=db.now()-datetime.timedelta(days=args.older_than) if args.older_than is not None else None
+            print(f"{db.archive_runs(args.keep_last, older_than)} runs archived.")
 
     if args.command=="report":
+        db.merge_journal()
         run_id,gcvb_id=db.get_last_run()
         if args.polling:
             while run_id is None:
@@ -314,7 +444,12 @@ def main():
         completed_tests, tests, finished = report_check_terminaison(run_id)
 
         if args.polling:
+            log = events.log_path(computation_dir, run_id)
             while not finished and time.time() - last_change < args.timeout :
+                if os.path.exists(log):
+                    # runs executed by jobrunners are followed through their events
+                    report_follow_events(log, run_id, args.timeout)
+                    break
                 completed_tests, tests, finished = report_check_terminaison(run_id)
                 if (previous_completed_tests != len(completed_tests)):
                     last_change = time.time()
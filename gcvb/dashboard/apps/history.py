@@ -7,13 +7,13 @@ if __name__ == '__main__':
 else:
     from ..app import app
 from dash.dependencies import Input, Output
-import gcvb.db as db
+import gcvb.history as history
 
 def gen_page(test_id, metric_id):
     #Data
-    res=db.retrieve_history(test_id,metric_id)
-    x=[a["run"] for a in res]
-    y=[a["value"] for a in res]
+    runs, values = history.cache.get([(test_id, metric_id)])[(test_id, metric_id)]
+    x=runs.tolist()
+    y=values.tolist()
     graph = dcc.Graph(figure={"data" : [{"x" : x, "y" : y}] })
 
     #Style
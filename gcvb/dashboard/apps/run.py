@@ -6,6 +6,7 @@ import gcvb.yaml_input as yaml_input
 import os
 from gcvb.loader import loader as loader
 import gcvb.model as model
+import gcvb.events as events
 import dash_defer_js_import as dji
 
 if __name__ == '__main__':
@@ -25,6 +26,15 @@ def data_preparation(run_id):
         res["cpu time (s)"].append(test.cpu_time())
     return res
 
+def progress(computation_dir, run_id):
+    """Load of the jobrunners of a run still in progress, from their last event."""
+    e = events.last_event(events.log_path(computation_dir, run_id))
+    if e is None or e["event"] == "runner_stopped":
+        return []
+    eta = f", about {e['eta']:.0f}s left" if e.get("eta") is not None else ""
+    return [html.P(f"In progress : {e['cores_in_use']}/{e['cores']} cores in use, "
+                   f"{e['running']} running and {e['ready']} ready tasks{eta}.")]
+
 # View
 def Table(report, run_id, columns=None):
     rows = []
@@ -53,6 +63,7 @@ def gen_page(run_id, gcvb_id):
         [
             dji.Import(src="/assets/sortable.js"),
             html.H1("Run"),
+            *progress(computation_dir, run_id),
             Table(data, run_id, data.keys()),
         ]
     )
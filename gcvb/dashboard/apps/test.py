@@ -44,6 +44,7 @@ def data_preparation(run, test_id):
         d["options"] = task["options"]
         d["metrics"] = []
         d["elapsed"] = task_obj.hr_elapsed()
+        d["usage"] = task_obj.hr_usage()
         _fill_files(d, task, ajc, "from_results")
         _fill_files(d, task, ajc, "from_db")
         for validation in task_obj.Validations:
@@ -136,6 +137,8 @@ def details_panel(data):
             el_list.append(html.Span(files))
         if t["status"] >= 0:
             el_list.append(html.Span([" Exit code: ", t["status"], f"({t['elapsed']})"]))
+            if t["usage"]:
+                el_list.append(html.Div(html.Small(t["usage"])))
         if t["metrics"]:
             el_list.append(metric_table(data, t["metrics"]))
         el_list.append(html.Hr())
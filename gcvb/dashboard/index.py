@@ -59,10 +59,13 @@ def serve_from_results(base, test, file):
 
 @app.server.route("/dbfiles/<base>/<test>/<filename>")
 def serve_from_db(base, test, filename):
-    return flask.send_file(
-        io.BytesIO(db.retrieve_file(int(base), test, filename)),
-        mimetype=_get_mimetype(base, test, filename)
-    )
+    mimetype = _get_mimetype(base, test, filename)
+    try:
+        f = db.open_file(int(base), test, filename)
+    except FileNotFoundError:
+        flask.abort(404)
+    # streamed, the file is never fully loaded in memory
+    return flask.send_file(f, mimetype=mimetype)
 
 @app.callback(Output('page-content', 'children'),
               [Input('url', 'pathname')])
@@ -1,7 +1,19 @@
 import sqlite3
+import array
+import math
 import os
+import sys
+import atexit
+import threading
 import glob
 import gzip
+import hashlib
+import io
+import itertools
+import json
+import socket
+import time
+import tempfile
 from collections import defaultdict
 from . import util
 import datetime
@@ -54,26 +66,192 @@ CREATE TABLE files(id       INTEGER PRIMARY KEY,
 CREATE TABLE yaml_cache(mtime REAL, filename TEXT, pickle BLOB);
 """
 
+#MIGRATIONS
+# migrations[i] is the list of statements upgrading the schema from version i
+# to version i+1. The version of a database is stored in PRAGMA user_version.
+# Never modify an existing entry, append a new one instead.
+migrations=[
+    # 1 : secondary indexes
+    ["CREATE INDEX IF NOT EXISTS test_run_name ON test(run_id, name)",
+     "CREATE INDEX IF NOT EXISTS task_test_step ON task(test_id, step)",
+     "CREATE INDEX IF NOT EXISTS task_status ON task(status)",
+     "CREATE INDEX IF NOT EXISTS valid_test_step ON valid(test_id, task_step)",
+     "CREATE INDEX IF NOT EXISTS valid_metric ON valid(metric)",
+     "CREATE INDEX IF NOT EXISTS files_test_filename ON files(test_id, filename)"],
+    # 2 : content-addressed blob store, files only maps a test file to a blob
+    ["""CREATE TABLE blob(hash TEXT PRIMARY KEY, -- sha256 of the uncompressed content (util.hash_file)
+                          file BLOB)             -- gzip compressed content, NULL if stored in blob_dir()""",
+     "ALTER TABLE files ADD COLUMN hash TEXT REFERENCES blob(hash)",
+     lambda conn: _files_to_blobs(conn)],
+    # 3 : configurable compression of blobs
+    # file must be the last column for zeroblob() not to be allocated in memory
+    ["CREATE TABLE blob_v3(hash TEXT PRIMARY KEY, codec TEXT DEFAULT 'gzip', file BLOB)",
+     "INSERT INTO blob_v3(hash, codec, file) SELECT hash, 'gzip', file FROM blob",
+     "DROP TABLE blob",
+     "ALTER TABLE blob_v3 RENAME TO blob"],
+    # 4 : runs moved to archive databases (see archive_runs)
+    ["CREATE TABLE archive(filename TEXT PRIMARY KEY, first_run INTEGER, last_run INTEGER)"],
+    # 5 : tasks claimed by a jobrunner, until lease_until unless renewed
+    ["ALTER TABLE task ADD COLUMN runner TEXT",
+     "ALTER TABLE task ADD COLUMN lease_until TIMESTAMP"],
+    # 6 : peak resident memory of tasks run by a jobrunner, in bytes
+    ["ALTER TABLE task ADD COLUMN max_rss INTEGER"],
+    # 7 : resource usage of tasks run by a jobrunner (see usage_columns)
+    ["ALTER TABLE task ADD COLUMN user_time REAL",
+     "ALTER TABLE task ADD COLUMN system_time REAL",
+     "ALTER TABLE task ADD COLUMN voluntary_switches INTEGER",
+     "ALTER TABLE task ADD COLUMN involuntary_switches INTEGER",
+     "ALTER TABLE task ADD COLUMN read_bytes INTEGER",
+     "ALTER TABLE task ADD COLUMN write_bytes INTEGER"],
+    # 8 : runs stopped with gcvb cancel
+    ["ALTER TABLE run ADD COLUMN cancel_date TIMESTAMP"],
+    # 9 : incremental recompute (see incremental.py)
+    ["ALTER TABLE task ADD COLUMN fingerprint TEXT",
+     "ALTER TABLE test ADD COLUMN copied_from INTEGER REFERENCES test(id)",
+     "CREATE INDEX IF NOT EXISTS test_name ON test(name)"],
+    # 10 : series metrics (see encode_series), value is then their mean
+    ["ALTER TABLE valid ADD COLUMN series BLOB"],
+    # 11 : journal files applied by merge_journal, until they are removed
+    ["CREATE TABLE journal_applied(name TEXT PRIMARY KEY)"],
+]
+schema_version=len(migrations)
+
+# task columns filled from os.wait4 : CPU times in seconds, memory and I/O in bytes
+usage_columns=["user_time", "system_time", "max_rss", "voluntary_switches", "involuntary_switches",
+               "read_bytes", "write_bytes"]
+
 def now():
     return datetime.datetime.now()
 
+def encode_series(values):
+    """float64 little-endian array, as stored in valid.series"""
+    a=array.array("d", values)
+    if sys.byteorder=="big":
+        a.byteswap()
+    return a.tobytes()
+
+def decode_series(blob):
+    a=array.array("d")
+    a.frombytes(blob)
+    if sys.byteorder=="big":
+        a.byteswap()
+    return a
+
+def _valid_rows(metrics, test_id, step):
+    """rows (metric, value, series, test_id, task_step) of valid. A value which is
+       a list, a tuple or an array.array is a series."""
+    res=[]
+    for name, value in metrics:
+        series=None
+        if isinstance(value, (list, tuple, array.array)):
+            series=encode_series(value)
+            value=math.fsum(value)/len(value) if len(value) else None
+        res.append((name, value, series, test_id, step))
+    return res
+
+_insert_valid="INSERT INTO valid(metric,value,series,test_id,task_step) VALUES (?,?,?,?,?)"
+
 #GLOBAL
 database="gcvb.db"
 synchronous=None
+journal_mode=None
+external_blobs=None
+compression=None
+journal=None
+_journal_counter=itertools.count()
+_pool=threading.local()
+_up_to_date=set()
 
 def set_db(db_path):
     global database, synchronous
     database=db_path
 
-def connect(file,f, *args, **kwargs):
-    global synchronous
-    conn=sqlite3.connect(file, timeout=50, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level='EXCLUSIVE')
+def _open(file):
+    global synchronous, journal_mode
+    # cached_statements : prepared statements are kept per connection, reusing
+    # the connection means queries are only compiled once.
+    conn=sqlite3.connect(file, timeout=50, detect_types=sqlite3.PARSE_DECLTYPES,
+                         isolation_level='EXCLUSIVE', cached_statements=256)
     if synchronous is None:
         # See https://www.sqlite.org/pragma.html#pragma_synchronous
         # OFF is known to be needed with Lustre
         synchronous = os.environ.get("GCVB_SYNC", "FULL")
+    if journal_mode is None:
+        # See https://www.sqlite.org/wal.html
+        # WAL is opt-in : it needs shared memory and does not work on network filesystems
+        journal_mode = os.environ.get("GCVB_JOURNAL_MODE", "")
+    if journal_mode:
+        conn.execute(f"PRAGMA journal_mode={journal_mode}")
     conn.execute(f"PRAGMA synchronous={synchronous}")
     conn.row_factory=sqlite3.Row
+    if file not in _up_to_date:
+        upgrade(conn)
+        _up_to_date.add(file)
+    return conn
+
+def _files_to_blobs(conn):
+    ids=[row[0] for row in conn.execute("SELECT id FROM files WHERE file IS NOT NULL")]
+    for i in ids:
+        content=conn.execute("SELECT file FROM files WHERE id=?", [i]).fetchone()[0]
+        h=hashlib.sha256(gzip.decompress(content)).hexdigest()
+        conn.execute("INSERT OR IGNORE INTO blob(hash,file) VALUES (?,?)", [h, content])
+        conn.execute("UPDATE files SET hash=?, file=NULL WHERE id=?", [h, i])
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def upgrade(conn):
+    """Apply the missing migrations to the database opened by conn.
+       Empty databases (not created yet) are left untouched."""
+    if get_schema_version(conn) >= schema_version:
+        return
+    conn.execute("BEGIN EXCLUSIVE")
+    try:
+        # another process may have upgraded the db while we were waiting for the lock
+        version=get_schema_version(conn)
+        created=conn.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='run'").fetchone()[0]
+        if created:
+            for statements in migrations[version:]:
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={schema_version}")
+    except:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+def get_connection(file=None):
+    """Returns the sqlite3.Connection to file (default: current database)
+       owned by the calling thread. The connection is reused by every call
+       from the same thread and process and must not be closed by the caller."""
+    path=os.path.abspath(file if file else database)
+    pid=os.getpid()
+    if getattr(_pool, "pid", None) != pid:
+        # never reuse a connection inherited through fork
+        _pool.pid=pid
+        _pool.connections={}
+    conn=_pool.connections.get(path)
+    if conn is None:
+        conn=_open(path)
+        _pool.connections[path]=conn
+    return conn
+
+def close_connections():
+    """Close every connection owned by the calling thread."""
+    if getattr(_pool, "pid", None) != os.getpid():
+        return
+    for conn in _pool.connections.values():
+        conn.close()
+    _pool.connections={}
+
+atexit.register(close_connections)
+
+def connect(file,f, *args, **kwargs):
+    conn=get_connection(file)
     c=conn.cursor()
     try:
         res = f(c, *args, **kwargs) #supposed to contain execute statements.
@@ -83,28 +261,94 @@ def connect(file,f, *args, **kwargs):
     else:
         conn.commit()
     finally:
-        conn.close()
+        c.close()
     return res
 
-def get_exclusive_access():
-    """Returns a sqlite3.Connection with exclusive access to the db.
-       Must be closed afterwards"""
-    conn=sqlite3.connect(database, timeout=50)
-    conn.execute(f"PRAGMA synchronous={synchronous}")
-    conn.row_factory=sqlite3.Row
-    conn.isolation_level = 'EXCLUSIVE'
-    conn.execute('BEGIN EXCLUSIVE')
-    return conn
-
 def with_connection(f):
     """decorator for function needing to connect to the database"""
     def with_connection_(*args, **kwargs):
         return connect(database,f, *args, **kwargs)
     return with_connection_
 
+def use_journal():
+    global journal
+    if journal is None:
+        # Status updates are written in journal files instead of the database.
+        # Designed for shared filesystems (Lustre) where many nodes updating
+        # gcvb.db is slow with synchronous=FULL and unsafe with OFF.
+        journal = os.environ.get("GCVB_DB_MODE", "direct") == "journal"
+    return journal
+
+def journal_dir():
+    """Directory, next to the database, where journal files are written"""
+    return os.path.abspath(database)+".journal"
+
+_journaled={}
+
+def journaled(f):
+    """decorator for updates that can be journaled. In journal mode the call
+       is written in a journal file, and applied later by merge_journal.
+       f must accept a date keyword argument (default: now)."""
+    _journaled[f.__name__]=f
+    def journaled_(*args, **kwargs):
+        if not use_journal():
+            return connect(database,f, *args, **kwargs)
+        kwargs.setdefault("date", now())
+        kwargs["date"]=kwargs["date"].isoformat()
+        event=json.dumps({"call" : f.__name__, "args" : args, "kwargs" : kwargs})
+        os.makedirs(journal_dir(), exist_ok=True)
+        # one file per event, renamed when complete : no locking is needed,
+        # even between nodes, and the merge never reads a partial event.
+        name=f"{time.time_ns():020d}-{socket.gethostname()}-{os.getpid()}-{next(_journal_counter)}"
+        tmp=os.path.join(journal_dir(), f".{name}.tmp")
+        with open(tmp, "w") as fp:
+            fp.write(event)
+        os.replace(tmp, os.path.join(journal_dir(), f"{name}.json"))
+    return journaled_
+
+def merge_journal():
+    """Apply the journaled updates, oldest first, in a single transaction.
+       Returns the number of updates applied."""
+    d=journal_dir()
+    if not os.path.isdir(d) or not any(n.endswith(".json") for n in os.listdir(d)):
+        return 0
+    conn=get_connection()
+    conn.execute("BEGIN EXCLUSIVE")
+    c=conn.cursor()
+    try:
+        # listed again with the lock : another process may have merged meanwhile
+        names=sorted(n for n in os.listdir(d) if n.endswith(".json"))
+        # files applied by another process, which has not removed them yet
+        c.execute("SELECT name FROM journal_applied")
+        applied={row["name"] for row in c.fetchall()}
+        c.executemany("DELETE FROM journal_applied WHERE name=?", [(n,) for n in applied.difference(names)])
+        todo=[n for n in names if n not in applied]
+        for name in todo:
+            with open(os.path.join(d, name), "r") as fp:
+                event=json.load(fp)
+            kwargs=event["kwargs"]
+            kwargs["date"]=datetime.datetime.fromisoformat(kwargs["date"])
+            _journaled[event["call"]](c, *event["args"], **kwargs)
+        c.executemany("INSERT INTO journal_applied(name) VALUES (?)", [(n,) for n in todo])
+    except:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        c.close()
+    # removed once committed, and recorded as applied until then
+    for name in names:
+        try:
+            os.remove(os.path.join(d, name))
+        except FileNotFoundError:
+            pass
+    return len(todo)
+
 @with_connection
 def create_db(cursor):
     cursor.executescript(creation_script)
+    upgrade(cursor.connection)
 
 @with_connection
 def new_gcvb_instance(cursor, command_line, yaml_file, modifier):
@@ -126,60 +370,83 @@ def add_run(cursor, gcvb_id, config_id):
     cursor.execute("INSERT INTO run(gcvb_id,config_id) VALUES (?,?)",[gcvb_id,config_id])
     return cursor.lastrowid
 
-@with_connection
-def add_tests(cursor, run, test_list, chain):
-    tests=[(t["id"],run) for t in test_list]
+def _insert_tests(cursor, run, test_list, chain):
+    if not cursor.connection.in_transaction:
+        # test ids are chosen here, no one else must insert tests meanwhile.
+        cursor.execute("BEGIN EXCLUSIVE")
+    cursor.execute("SELECT coalesce(max(id), 0) AS id FROM test")
+    next_id=cursor.fetchone()["id"]+1
+    tests=[]
+    tasks=[]
     for t in test_list:
-        cursor.execute("INSERT INTO test(name,run_id) VALUES(?,?)",[t["id"],run])
-        t["id_db"]=cursor.lastrowid
+        t["id_db"]=next_id
+        next_id+=1
+        tests.append((t["id_db"], t["id"], run))
         step=0
         parent = 0
         for task in t["Tasks"]:
             step += 1
             predecessor = step - 1 if chain else parent
             status = -3 if parent else -2 #Ready (-2) if parent is 0 else Pending (-3)
-            cursor.execute("INSERT INTO task(step,parent,test_id,status) VALUES(?,?,?,?)",
-                           [step, predecessor, t["id_db"], status])
+            tasks.append((step, predecessor, t["id_db"], status))
             parent = step
             for valid in task.get("Validations",[]):
                 step += 1
                 predecessor = step - 1 if chain else parent
-                cursor.execute("INSERT INTO task(step,parent,test_id) VALUES (?,?,?)",
-                               [step,predecessor,t["id_db"]])
+                tasks.append((step, predecessor, t["id_db"], -3))
+    cursor.executemany("INSERT INTO test(id,name,run_id) VALUES(?,?,?)", tests)
+    cursor.executemany("INSERT INTO task(step,parent,test_id,status) VALUES(?,?,?,?)", tasks)
 
+@with_connection
+def add_tests(cursor, run, test_list, chain):
+    _insert_tests(cursor, run, test_list, chain)
 
 @with_connection
-def start_test(cursor,run,test_id):
+def add_runs(cursor, gcvb_id, config_id, batches, chain):
+    """Create one run per batch (list of tests) in a single transaction.
+       Returns the list of run ids."""
+    cursor.execute("BEGIN EXCLUSIVE")
+    runs=[]
+    for test_list in batches:
+        cursor.execute("INSERT INTO run(gcvb_id,config_id) VALUES (?,?)",[gcvb_id,config_id])
+        runs.append(cursor.lastrowid)
+        _insert_tests(cursor, runs[-1], test_list, chain)
+    return runs
+
+@journaled
+def start_test(cursor,run,test_id,date=None):
     cursor.execute("""UPDATE test
                       SET start_date = ?
-                      WHERE id = ? AND run_id = ?""",[now(), test_id, run])
+                      WHERE id = ? AND run_id = ?""",[date or now(), test_id, run])
 
-@with_connection
-def end_test(cursor, run, test_id):
+@journaled
+def end_test(cursor, run, test_id, date=None):
     cursor.execute("""UPDATE test
                       SET end_date = ?
-                      WHERE id = ? AND run_id = ?""",[now(), test_id, run])
+                      WHERE id = ? AND run_id = ?""",[date or now(), test_id, run])
 
-@with_connection
-def start_task(cursor, test_id, step):
+@journaled
+def start_task(cursor, test_id, step, date=None):
     cursor.execute("""UPDATE task
                       SET start_date = ?, status = -1
-                      WHERE step = ? AND test_id = ?""", [now(), step, test_id])
+                      WHERE step = ? AND test_id = ?""", [date or now(), step, test_id])
 
-@with_connection
-def end_task(cursor, test_id, step, exit_status):
+@journaled
+def end_task(cursor, test_id, step, exit_status, metrics=(), date=None):
+    """metrics -- iterable of (name, value) recorded in the same transaction"""
     cursor.execute("""UPDATE task
                       SET end_date = ?, status = ?
-                      WHERE step = ? AND test_id = ?""", [now(), exit_status, step, test_id])
+                      WHERE step = ? AND test_id = ?""", [date or now(), exit_status, step, test_id])
+    cursor.executemany(_insert_valid, _valid_rows(metrics, test_id, step))
 
-@with_connection
-def start_run(cursor,run):
+@journaled
+def start_run(cursor,run,date=None):
     #update only if there is no start date already.
     #Multiple launch scripts can be started, and we might not be the first.
     cursor.execute("""UPDATE run
                       SET start_date = ?
                       WHERE id = ?
-                        AND start_date IS NULL""",[now(), run])
+                        AND start_date IS NULL""",[date or now(), run])
 
 @with_connection
 def end_run(cursor,run):
@@ -195,8 +462,177 @@ def end_run(cursor,run):
                           WHERE id = ?""",[now(), run])
 
 @with_connection
-def add_metric(cursor, run_id, test_id, step, name, value):
-    cursor.execute("INSERT INTO valid(metric,value,test_id,task_step) VALUES (?,?,?,?)",[name,value,test_id, step])
+def cancel_run(cursor, run_id):
+    """Tasks of the run which are not started yet are cancelled (status -6). Running tasks
+       are killed by their jobrunner. Returns the number of running tasks."""
+    date=now()
+    cursor.execute("UPDATE run SET cancel_date = ? WHERE id = ?", [date, run_id])
+    cursor.execute("""UPDATE task
+                      SET status = -6, end_date = ?
+                      WHERE status IN (-3, -2)
+                        AND test_id IN (SELECT id FROM test WHERE run_id = ?)""", [date, run_id])
+    cursor.execute("""UPDATE test
+                      SET end_date = ?
+                      WHERE run_id = ? AND end_date IS NULL
+                        AND NOT EXISTS (SELECT 1 FROM task WHERE task.test_id = test.id AND task.status = -1)""",
+                   [date, run_id])
+    cursor.execute("""SELECT count(*) FROM task
+                      INNER JOIN test ON test.id=task.test_id
+                      WHERE test.run_id = ? AND task.status = -1""", [run_id])
+    running=cursor.fetchone()[0]
+    if not running:
+        cursor.execute("UPDATE run SET end_date = ? WHERE id = ? AND end_date IS NULL", [date, run_id])
+    return running
+
+@with_connection
+def is_cancelled(cursor, run_id):
+    cursor.execute("SELECT cancel_date FROM run WHERE id = ?", [run_id])
+    return cursor.fetchone()["cancel_date"] is not None
+
+@with_connection
+def set_fingerprints(cursor, fingerprints):
+    """fingerprints -- iterable of (fingerprint, test_id, step)"""
+    cursor.executemany("UPDATE task SET fingerprint = ? WHERE test_id = ? AND step = ?", fingerprints)
+
+@with_connection
+def copy_unchanged_tests(cursor, run_id):
+    """Tests of run_id whose tasks have the fingerprints of a successful previous test are
+       completed with its metrics and kept files. Returns the names of these tests."""
+    cursor.execute("BEGIN EXCLUSIVE")
+    cursor.execute("""SELECT cur.id, cur.name, max(prev.id) AS previous
+                      FROM test AS cur
+                      INNER JOIN test AS prev ON prev.name = cur.name AND prev.id < cur.id
+                      WHERE cur.run_id = ? AND prev.end_date IS NOT NULL
+                        AND (SELECT count(*) FROM task WHERE test_id = prev.id)
+                            = (SELECT count(*) FROM task WHERE test_id = cur.id)
+                        AND NOT EXISTS (SELECT 1 FROM task AS t
+                                        LEFT JOIN task AS p ON p.test_id = prev.id AND p.step = t.step
+                                        WHERE t.test_id = cur.id
+                                          AND (t.fingerprint IS NULL OR p.status IS NOT 0
+                                               OR p.fingerprint IS NOT t.fingerprint))
+                      GROUP BY cur.id""", [run_id])
+    copies=cursor.fetchall()
+    date=now()
+    for c in copies:
+        cursor.execute("""INSERT INTO valid(metric, value, series, test_id, task_step)
+                          SELECT metric, value, series, ?, task_step FROM valid WHERE test_id = ?""", [c["id"], c["previous"]])
+        # blobs are shared
+        cursor.execute("""INSERT INTO files(filename, hash, test_id)
+                          SELECT filename, hash, ? FROM files WHERE test_id = ?""", [c["id"], c["previous"]])
+        # dates and usage of the task they are copied from, but they are not part
+        # of the duration history (see get_task_durations)
+        copied=", ".join(["start_date", "end_date"]+usage_columns)
+        cursor.execute(f"""UPDATE task SET status = 0, ({copied}) =
+                             (SELECT {copied} FROM task AS prev WHERE prev.test_id = ? AND prev.step = task.step)
+                           WHERE test_id = ?""", [c["previous"], c["id"]])
+        cursor.execute("UPDATE test SET start_date = ?, end_date = ?, copied_from = ? WHERE id = ?",
+                       [date, date, c["previous"], c["id"]])
+    return [c["name"] for c in copies]
+
+@journaled
+def add_metric(cursor, run_id, test_id, step, name, value, date=None):
+    cursor.executemany(_insert_valid, _valid_rows([(name, value)], test_id, step))
+
+@journaled
+def add_metrics(cursor, run_id, test_id, step, metrics, date=None):
+    """metrics -- iterable of (name, value)"""
+    cursor.executemany(_insert_valid, _valid_rows(metrics, test_id, step))
+
+@with_connection
+def get_tasks(cursor, run_id):
+    request="""SELECT test.name, task.step, task.parent, task.status
+               FROM task
+               INNER JOIN test ON test.id=task.test_id
+               WHERE test.run_id = ?"""
+    cursor.execute(request, [run_id])
+    return cursor.fetchall()
+
+@with_connection
+def claim_task(cursor, run_id, test_id, step, runner, lease_until, is_first):
+    """Mark a task as running by runner if no one else did.
+       Returns True if the task is claimed."""
+    cursor.execute("""UPDATE task
+                      SET start_date = ?, status = -1, runner = ?, lease_until = ?
+                      WHERE step = ? AND test_id = ? AND status IN (-3, -2)""",
+                   [now(), runner, lease_until, step, test_id])
+    if not cursor.rowcount:
+        return False
+    if is_first:
+        cursor.execute("""UPDATE test
+                          SET start_date = ?
+                          WHERE id = ? AND run_id = ?""",[now(), test_id, run_id])
+    return True
+
+@with_connection
+def end_tasks(cursor, run_id, results):
+    """Record many completed tasks at once.
+
+    results -- iterable of dict with keys test_id, step, status, date,
+               metrics (list of (name, value)), end_test (bool),
+               children_ready (bool) and optionally usage (dict, see usage_columns)
+    """
+    usage_set="".join(f", {c} = ?" for c in usage_columns)
+    for r in results:
+        usage=r.get("usage") or {}
+        cursor.execute(f"""UPDATE task
+                           SET end_date = ?, status = ?, lease_until = NULL{usage_set}
+                           WHERE step = ? AND test_id = ?""",
+                       [r["date"], r["status"]] + [usage.get(c) for c in usage_columns] + [r["step"], r["test_id"]])
+        cursor.executemany(_insert_valid, _valid_rows(r["metrics"], r["test_id"], r["step"]))
+        if r["end_test"]:
+            cursor.execute("""UPDATE test
+                              SET end_date = ?
+                              WHERE id = ? AND run_id = ?""", [r["date"], r["test_id"], run_id])
+        if r["children_ready"]:
+            cursor.execute("""UPDATE task
+                              SET status = -2
+                              WHERE parent = ? AND test_id = ? AND status = -3""", [r["step"], r["test_id"]])
+
+@with_connection
+def renew_leases(cursor, runner, lease_until):
+    cursor.execute("""UPDATE task
+                      SET lease_until = ?
+                      WHERE runner = ? AND status = -1""", [lease_until, runner])
+
+@with_connection
+def release_task(cursor, test_id, step, runner):
+    """A task claimed by runner will not be completed by it, it is ready again."""
+    cursor.execute("""UPDATE task
+                      SET status = -2, runner = NULL, lease_until = NULL
+                      WHERE step = ? AND test_id = ? AND runner = ? AND status = -1""", [step, test_id, runner])
+
+@with_connection
+def release_expired_leases(cursor, run_id):
+    """Tasks claimed by a jobrunner which did not renew its lease are ready again."""
+    cursor.execute("""UPDATE task
+                      SET status = -2, runner = NULL, lease_until = NULL
+                      WHERE status = -1 AND lease_until < ?
+                        AND test_id IN (SELECT id FROM test WHERE run_id = ?)""", [now(), run_id])
+    return cursor.rowcount
+
+@with_connection
+def get_task_durations(cursor, first_run=0, last_run=None):
+    """Returns (test name, step, status, duration in seconds) of the tasks
+       completed during runs first_run to last_run (included)."""
+    request="""SELECT test.name, task.step, task.status,
+                      (julianday(task.end_date)-julianday(task.start_date))*86400. AS duration
+               FROM task
+               INNER JOIN test ON test.id=task.test_id
+               WHERE test.run_id >= ? AND test.run_id <= ? AND test.copied_from IS NULL
+                 AND task.start_date IS NOT NULL AND task.end_date IS NOT NULL"""
+    cursor.execute(request, [first_run, last_run if last_run is not None else 2**62])
+    return cursor.fetchall()
+
+@with_connection
+def get_peak_memory(cursor, last_run=None):
+    """Returns the largest max_rss recorded for each (test name, step) up to last_run."""
+    request="""SELECT test.name, task.step, MAX(task.max_rss) AS max_rss
+               FROM task
+               INNER JOIN test ON test.id=task.test_id
+               WHERE task.max_rss IS NOT NULL AND test.run_id <= ?
+               GROUP BY test.name, task.step"""
+    cursor.execute(request, [last_run if last_run is not None else 2**62])
+    return {(r["name"], r["step"]) : r["max_rss"] for r in cursor.fetchall()}
 
 @with_connection
 def get_last_run(cursor):
@@ -207,6 +643,24 @@ def get_last_run(cursor):
     else:
         return res["id"], res["gcvb_id"]
 
+@with_connection
+def get_run_summary(cursor, run_id):
+    """Counts of the tests and tasks of a run, and the sum of their resource usage
+       (maximum for max_rss, None if no task was measured)."""
+    cursor.execute("""SELECT count(*) AS tests, count(end_date) AS completed_tests
+                      FROM test WHERE run_id = ?""", [run_id])
+    res=dict(cursor.fetchone())
+    sums=", ".join(f"max({c}) AS {c}" if c == "max_rss" else f"sum({c}) AS {c}" for c in usage_columns)
+    cursor.execute(f"""SELECT count(*) AS tasks, count(task.end_date) AS completed_tasks,
+                              count(user_time) AS measured_tasks, {sums}
+                       FROM task
+                       INNER JOIN test ON test.id=task.test_id
+                       WHERE test.run_id = ?""", [run_id])
+    row=dict(cursor.fetchone())
+    res.update({k : row.pop(k) for k in ["tasks", "completed_tasks", "measured_tasks"]})
+    res["usage"]=row if res["measured_tasks"] else None
+    return res
+
 @with_connection
 def get_run_infos(cursor, run_id):
     cursor.execute("SELECT * from run WHERE id = ?", [run_id])
@@ -238,37 +692,263 @@ def load_report(cursor, run_id):
     return res
 
 @with_connection
-def load_report_n(cursor, run_id):
-    a="""SELECT metric, value, name, task_step
+def load_report_n(cursor, run_id, test_name=None):
+    a="""SELECT metric, value, series, name, task_step
          FROM valid
          INNER JOIN test
          ON test_id=test.id
          WHERE test.run_id=(?)"""
-    cursor.execute(a,[run_id])
+    if test_name is not None:
+        a+=" AND test.name=(?)"
+    cursor.execute(a,[run_id] if test_name is None else [run_id, test_name])
     res = defaultdict(lambda : defaultdict(dict))
     for t in cursor.fetchall():
-        res[t["name"]][t["task_step"]][t["metric"]]=t["value"]
+        value=t["value"] if t["series"] is None else decode_series(t["series"])
+        res[t["name"]][t["task_step"]][t["metric"]]=value
     return res
 
 
+def blob_dir():
+    """Directory, next to the database, where external blobs are stored"""
+    return os.path.abspath(database)+".blobs"
+
+def _blob_path(h, codec="gzip"):
+    return os.path.join(blob_dir(), h[:2], h+util.codecs[codec])
+
+def _use_external_blobs():
+    global external_blobs
+    if external_blobs is None:
+        # Store kept files outside of the database to keep it small
+        external_blobs = os.environ.get("GCVB_EXTERNAL_BLOBS", "0") not in ["", "0"]
+    return external_blobs
+
+def get_compression():
+    global compression
+    if compression is None:
+        # <codec>[:<level>], e.g. gzip:6 or zstd:3
+        codec, _, level = os.environ.get("GCVB_COMPRESSION", "gzip").partition(":")
+        if codec not in util.codecs:
+            raise ValueError(f"GCVB_COMPRESSION : unknown codec '{codec}'. Available : {', '.join(util.codecs)}")
+        if codec == "zstd":
+            util.zstandard_module() # fail early if not installed
+        compression = (codec, int(level) if level else None)
+    return compression
+
+def compress_for_storage(filename):
+    """Compress filename into a temporary file next to the database.
+       Returns (path, codec) to be given to save_blobs which consumes the file."""
+    codec, level = get_compression()
+    fd, path = tempfile.mkstemp(prefix=".gcvb_blob_", dir=os.path.dirname(os.path.abspath(database)))
+    os.close(fd)
+    try:
+        util.compress_file(filename, path, codec, level)
+    except:
+        os.remove(path)
+        raise
+    return path, codec
+
+def _insert_blob(cursor, h, compressed):
+    """compressed -- (path, codec) as returned by compress_for_storage"""
+    path, codec = compressed
+    cursor.execute("SELECT 1 FROM blob WHERE hash=?", [h])
+    if cursor.fetchone() is not None:
+        if os.path.exists(path): # may have been consumed if a journal is merged twice
+            os.remove(path)
+        return
+    if _use_external_blobs():
+        dst=_blob_path(h, codec)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(path, dst)
+        cursor.execute("INSERT INTO blob(hash,file,codec) VALUES (?,NULL,?)", [h, codec])
+        return
+    size=os.path.getsize(path)
+    cursor.execute("INSERT INTO blob(hash,file,codec) VALUES (?,zeroblob(?),?)", [h, size, codec])
+    with open(path, "rb") as f:
+        if hasattr(cursor.connection, "blobopen"):
+            # incremental blob I/O (python >= 3.11)
+            with cursor.connection.blobopen("blob", "file", cursor.lastrowid) as b:
+                for chunk in iter(lambda: f.read(util.CHUNK_SIZE), b""):
+                    b.write(chunk)
+        else:
+            cursor.execute("UPDATE blob SET file=? WHERE rowid=?", [f.read(), cursor.lastrowid])
+    os.remove(path)
+
 @with_connection
-def save_blobs(cursor, data):
-    request="""INSERT INTO files(filename,file, test_id)
+def get_known_blobs(cursor, hashes):
+    """Returns the subset of hashes already stored."""
+    hashes=list(hashes)
+    res=set()
+    for i in range(0, len(hashes), 500):
+        chunk=hashes[i:i+500]
+        cursor.execute(f"SELECT hash FROM blob WHERE hash IN ({','.join('?'*len(chunk))})", chunk)
+        res.update(row["hash"] for row in cursor.fetchall())
+    return res
+
+@journaled
+def save_blobs(cursor, data, date=None):
+    """data -- iterable of (filename, hash, compressed, test_id).
+               compressed is given by compress_for_storage, it may be None
+               if the hash is already stored."""
+    request="""INSERT INTO files(filename, hash, test_id)
                VALUES (?,?,?)"""
 
-    for params in data:
-        cursor.execute(request, params)
+    for filename, h, compressed, test_id in data:
+        if compressed is not None:
+            _insert_blob(cursor, h, compressed)
+        cursor.execute(request, [filename, h, test_id])
+
 
+def save_files(run_id, test_id, file_list):
+    files={file : util.hash_file(file) for pattern in file_list for file in glob.iglob(pattern)}
+    # in journal mode the database is not read, blobs are deduplicated by merge_journal.
+    known=set() if use_journal() else get_known_blobs(set(files.values()))
+    data=[]
+    for file, h in files.items():
+        compressed=None
+        if h not in known:
+            compressed=compress_for_storage(file)
+            known.add(h)
+        data.append((file, h, compressed, test_id))
+    save_blobs(data)
 
 @with_connection
-def save_files(cursor, run_id, test_id, file_list):
-    request="""INSERT INTO files(filename,file, test_id)
-               VALUES (?,?,?)"""
+def delete_unused_blobs(cursor):
+    """Delete blobs no longer referenced by a file. Returns the number of blobs deleted."""
+    unused="hash NOT IN (SELECT hash FROM files WHERE hash IS NOT NULL)"
+    cursor.execute(f"SELECT hash, codec FROM blob WHERE typeof(file)='null' AND {unused}")
+    deleted={_blob_path(row["hash"], row["codec"]) for row in cursor.fetchall()}
+    cursor.execute(f"DELETE FROM blob WHERE {unused}")
+    count=cursor.rowcount
+    # archives cannot be attached within a transaction
+    cursor.connection.commit()
+    # external blobs are shared with the archives, only those left are used
+    used=set()
+    for schema in _attach_archives(cursor):
+        cursor.execute(f"SELECT hash, codec FROM {schema}.blob WHERE typeof(file)='null'")
+        used.update(_blob_path(row["hash"], row["codec"]) for row in cursor.fetchall())
+    for path in glob.glob(os.path.join(blob_dir(), "*", "*")):
+        if path not in used:
+            os.remove(path)
+            # already counted with its row
+            count+=path not in deleted
+    return count
+
+def gc():
+    """Reclaim the space used by blobs no longer referenced.
+       Returns the number of blobs deleted."""
+    count=delete_unused_blobs()
+    get_connection().execute("VACUUM")
+    return count
+
+def archive_dir():
+    """Directory, next to the database, where archive databases are stored"""
+    return os.path.abspath(database)+".archives"
+
+def _attach_archives(cursor, since_run=0):
+    """Yields the schema to query, one at a time : "arch" for every archive
+       holding runs newer than since_run (attached in turn, oldest first),
+       then "main". Must not be called within a transaction, and the results
+       of a schema must be fetched before getting the next one."""
+    cursor.execute("SELECT filename FROM archive WHERE last_run > ? ORDER BY first_run", [since_run])
+    for row in cursor.fetchall():
+        cursor.execute("ATTACH DATABASE ? AS arch", [os.path.join(archive_dir(), row["filename"])])
+        try:
+            yield "arch"
+        finally:
+            cursor.execute("DETACH DATABASE arch")
+    yield "main"
+
+@with_connection
+def get_runs_to_archive(cursor, keep_last=None, older_than=None):
+    """Returns the list of (run id, period) matching every criterion.
+
+    Keyword arguments:
+    keep_last  -- the keep_last most recent runs are not archived
+    older_than -- only runs ended (or started) before this datetime are archived
+
+    The most recent run is never archived : ids are not AUTOINCREMENT, the ids
+    of an archived run would be given again to the next one.
+    """
+    request="""SELECT run.id, coalesce(run.start_date, gcvb.creation_date) AS date
+               FROM run LEFT JOIN gcvb ON gcvb.id=run.gcvb_id
+               WHERE run.id < (SELECT max(id) FROM run)"""
+    params=[]
+    if keep_last is not None:
+        request+=" AND run.id NOT IN (SELECT id FROM run ORDER BY id DESC LIMIT ?)"
+        params.append(keep_last)
+    if older_than is not None:
+        request+=" AND coalesce(run.end_date, run.start_date) < ?"
+        params.append(older_than)
+    cursor.execute(request+" ORDER BY run.id", params)
+    res=[]
+    for row in cursor.fetchall():
+        date=row["date"]
+        if isinstance(date, str):
+            date=datetime.datetime.fromisoformat(date)
+        res.append((row["id"], date.strftime("%Y-%m") if date else "undated"))
+    return res
 
-    for pattern in file_list:
-        for file in glob.iglob(pattern):
-            content=util.file_to_compressed_binary(file)
-            cursor.execute(request,[file,content,test_id])
+_valid_columns="metric, value, series, test_id, task_step"
+_files_columns="filename, file, test_id, hash"
+_archive_requests=[
+    "INSERT OR IGNORE INTO arch.gcvb SELECT * FROM main.gcvb WHERE id=(SELECT gcvb_id FROM main.run WHERE id=:run)",
+    "INSERT INTO arch.run SELECT * FROM main.run WHERE id=:run",
+    "INSERT INTO arch.test SELECT * FROM main.test WHERE run_id=:run",
+    "INSERT INTO arch.task SELECT * FROM main.task WHERE test_id IN (SELECT id FROM main.test WHERE run_id=:run)",
+    # ids of valid and files are not referenced, and may be given again by main
+    f"""INSERT INTO arch.valid({_valid_columns}) SELECT {_valid_columns} FROM main.valid
+         WHERE test_id IN (SELECT id FROM main.test WHERE run_id=:run)""",
+    """INSERT OR IGNORE INTO arch.blob SELECT * FROM main.blob WHERE hash IN
+         (SELECT hash FROM main.files WHERE test_id IN (SELECT id FROM main.test WHERE run_id=:run))""",
+    f"""INSERT INTO arch.files({_files_columns}) SELECT {_files_columns} FROM main.files
+         WHERE test_id IN (SELECT id FROM main.test WHERE run_id=:run)""",
+    "DELETE FROM main.valid WHERE test_id IN (SELECT id FROM main.test WHERE run_id=:run)",
+    "DELETE FROM main.task WHERE test_id IN (SELECT id FROM main.test WHERE run_id=:run)",
+    "DELETE FROM main.files WHERE test_id IN (SELECT id FROM main.test WHERE run_id=:run)",
+    "DELETE FROM main.test WHERE run_id=:run",
+    "DELETE FROM main.run WHERE id=:run",
+]
+
+def archive_runs(keep_last=None, older_than=None):
+    """Move old runs to one archive database per month (see archive_dir)
+       then compact the database. History queries still read the archives.
+       Returns the number of archived runs."""
+    runs=get_runs_to_archive(keep_last, older_than)
+    periods=defaultdict(list)
+    for run, period in runs:
+        periods[period].append(run)
+    os.makedirs(archive_dir(), exist_ok=True)
+    conn=get_connection()
+    for period, run_list in periods.items():
+        filename=f"{period}.db"
+        path=os.path.join(archive_dir(), filename)
+        arch=sqlite3.connect(path)
+        if not get_schema_version(arch):
+            arch.executescript(creation_script)
+        # archives created before a migration must have the columns of main
+        upgrade(arch)
+        arch.close()
+        conn.execute("ATTACH DATABASE ? AS arch", [path])
+        try:
+            conn.execute("BEGIN EXCLUSIVE")
+            try:
+                for run in run_list:
+                    for request in _archive_requests:
+                        conn.execute(request, {"run" : run})
+                conn.execute("""INSERT INTO archive(filename, first_run, last_run) VALUES (?,?,?)
+                                ON CONFLICT(filename) DO UPDATE SET first_run=min(first_run, excluded.first_run),
+                                                                    last_run=max(last_run, excluded.last_run)""",
+                             [filename, min(run_list), max(run_list)])
+            except:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+        finally:
+            conn.execute("DETACH DATABASE arch")
+    if runs:
+        gc()
+    return len(runs)
 
 @with_connection
 def save_yaml_cache(cursor, mtime, filename, res_dict):
@@ -308,15 +988,51 @@ def get_file_list(cursor, run_id, test_name):
     res=cursor.fetchall()
     return [f["filename"] for f in res]
 
-@with_connection
-def retrieve_file(cursor, run_id, test_name, filename):
-    request="""SELECT file
+blob_chunk=2**20 # bytes read from the database at once by open_file
+
+class _BlobReader(io.RawIOBase):
+    """Incremental blob I/O (python >= 3.11). The blob is opened again for each
+       chunk : an open blob keeps the database locked for writers."""
+    def __init__(self, conn, rowid):
+        self.conn=conn
+        self.rowid=rowid
+        self.offset=0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        with self.conn.blobopen("blob", "file", self.rowid, readonly=True) as blob:
+            blob.seek(self.offset)
+            data=blob.read(len(b))
+        b[:len(data)]=data
+        self.offset+=len(data)
+        return len(data)
+
+def open_file(run_id, test_name, filename):
+    """Returns a binary file object streaming the content of a kept file.
+       The content is never fully loaded in memory. Must be closed afterwards."""
+    request="""SELECT blob.rowid, blob.hash, blob.codec, typeof(blob.file)='null' AS external
                FROM files
+               INNER JOIN blob ON files.hash=blob.hash
                INNER JOIN test ON test_id=test.id
                INNER JOIN run ON test.run_id=run.id
                WHERE run.gcvb_id = ? AND test.name = ? AND filename = ?"""
-    cursor.execute(request, [run_id,test_name, filename])
-    return gzip.decompress(cursor.fetchone()["file"])
+    conn=get_connection()
+    res=conn.execute(request, [run_id,test_name, filename]).fetchone()
+    if res is None:
+        raise FileNotFoundError(f"{filename} is not stored for test {test_name}")
+    if res["external"]:
+        f=open(_blob_path(res["hash"], res["codec"]), "rb")
+    elif hasattr(conn, "blobopen"):
+        f=io.BufferedReader(_BlobReader(conn, res["rowid"]), buffer_size=blob_chunk)
+    else:
+        f=io.BytesIO(conn.execute("SELECT file FROM blob WHERE rowid=?", [res["rowid"]]).fetchone()[0])
+    return util.open_decompressed(f, res["codec"])
+
+def retrieve_file(run_id, test_name, filename):
+    with open_file(run_id, test_name, filename) as f:
+        return f.read()
 
 @with_connection
 def retrieve_input(cursor, run):
@@ -344,22 +1060,70 @@ def retrieve_test(cursor, run, test_id):
     return res
 
 @with_connection
-def retrieve_history(cursor, test_id, metric_id):
-    request="""SELECT metric, value, test.run_id as run, test.name as test_id
-               FROM valid
-               INNER JOIN test ON test.id=valid.test_id
-               WHERE test.name=? AND valid.metric=?"""
-    cursor.execute(request,[test_id,metric_id])
-    res=cursor.fetchall()
+def retrieve_history(cursor, test_id, metric_id, since_run=0):
+    res=[]
+    for schema in _attach_archives(cursor, since_run):
+        request=f"""SELECT metric, value, test.run_id as run, test.name as test_id
+                    FROM {schema}.valid
+                    INNER JOIN {schema}.test ON test.id=valid.test_id
+                    WHERE test.name=? AND valid.metric=? AND test.run_id > ?"""
+        cursor.execute(request,[test_id,metric_id,since_run])
+        res.extend(cursor.fetchall())
+    return res
+
+@with_connection
+def retrieve_histories(cursor, pairs, since_run=0):
+    """Returns the list of (test name, metric, run id, value) for every
+       (test name, metric) in pairs and run id > since_run, ordered by run id."""
+    pairs=list(pairs)
+    res=[]
+    for schema in _attach_archives(cursor, since_run):
+        for i in range(0, len(pairs), 400):
+            chunk=pairs[i:i+400]
+            request=f"""WITH pairs(name, metric) AS (VALUES {','.join(['(?,?)']*len(chunk))})
+                        SELECT test.name, valid.metric, test.run_id, valid.value
+                        FROM pairs
+                        INNER JOIN {schema}.valid ON valid.metric=pairs.metric
+                        INNER JOIN {schema}.test ON test.id=valid.test_id AND test.name=pairs.name
+                        WHERE test.run_id > ?"""
+            cursor.execute(request, [e for p in chunk for e in p]+[since_run])
+            res.extend(tuple(row) for row in cursor.fetchall())
+    res.sort(key=lambda row: row[2])
     return res
 
+def iter_history(since_run=0):
+    """Yields (test name, metric, run id, value) for every recorded metric
+       of runs newer than since_run, without loading them all in memory."""
+    c=get_connection().cursor()
+    try:
+        for schema in _attach_archives(c, since_run):
+            request=f"""SELECT test.name, valid.metric, test.run_id, valid.value
+                        FROM {schema}.valid
+                        INNER JOIN {schema}.test ON test.id=valid.test_id
+                        WHERE test.run_id > ?
+                        ORDER BY test.run_id"""
+            for row in c.execute(request, [since_run]):
+                yield tuple(row)
+    finally:
+        c.close()
+
 @with_connection
-def get_steps(cursor, run_id):
-    request="""SELECT test.name, step, task.start_date, task.end_date, status
+def get_last_stable_run(cursor):
+    """Returns the id of the last run such as every run up to it is completed:
+       their metrics will not change anymore."""
+    cursor.execute("""SELECT coalesce(min(id)-1, (SELECT max(id) FROM run), 0) AS id
+                      FROM run WHERE end_date IS NULL""")
+    return cursor.fetchone()["id"]
+
+@with_connection
+def get_steps(cursor, run_id, test_name=None):
+    request=f"""SELECT test.name, step, task.start_date, task.end_date, status, {", ".join(usage_columns)}
                FROM task
                INNER JOIN test ON test.id=task.test_id
                WHERE test.run_id = ?"""
-    cursor.execute(request, [run_id])
+    if test_name is not None:
+        request+=" AND test.name = ?"
+    cursor.execute(request, [run_id] if test_name is None else [run_id, test_name])
     res = defaultdict(lambda : defaultdict(dict))
     for t in cursor.fetchall():
         res[t["name"]][t["step"]]=dict(t)
@@ -0,0 +1,206 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+from . import db
+from . import jobrunner
+
+default_port = 8060
+worker_poll_interval = 0.5 # seconds, delay between two requests of an idle worker
+
+def parse_address(address, default_host="127.0.0.1"):
+    """'host:port', 'host' or 'port' -> (host, port)"""
+    host, _, port = address.rpartition(":")
+    if not host and not port.isdigit():
+        host, port = port, default_port
+    return host or default_host, int(port)
+
+class WorkerView(object):
+    """Resources of a connected worker, as seen by the coordinator (and by the scheduling policy)."""
+    def __init__(self, name, num_cores, max_memory, clock):
+        self.name = name
+        self.available_cores = num_cores
+        self.available_memory = max_memory
+        self.running_tests = {}
+        self.clock = clock
+
+class _Handler(socketserver.StreamRequestHandler):
+    """One connection per worker, requests and replies are JSON lines."""
+    def handle(self):
+        coordinator = self.server.coordinator
+        view = None
+        try:
+            for line in self.rfile:
+                request = json.loads(line)
+                with coordinator.lock:
+                    if request["request"] == "hello":
+                        view = WorkerView(request["name"], request["cores"], request["memory"], coordinator.clock)
+                        coordinator.workers.add(view)
+                        reply = {"directory" : os.getcwd(), "run_id" : coordinator.run_id}
+                    elif request["request"] == "job":
+                        reply = coordinator.request_job(view)
+                    elif request["request"] == "end":
+                        reply = coordinator.end_job(view, request)
+                self.wfile.write((json.dumps(reply) + "\n").encode())
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            if view is not None:
+                with coordinator.lock:
+                    coordinator.disconnect(view)
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class Coordinator(jobrunner.JobRunner):
+    """
+    Owns the database and hands out the jobs of a run to workers connected
+    with TCP (see Worker). Scheduling is the same as for a JobRunner, except that
+    the resources considered are those of the worker asking for a job.
+    """
+    def __init__(self, run_id, config, started_first, verbose, address, test_yaml=None,
+                 compression_workers=2, policy=None, timeout_factor=None, min_timeout=60, events_socket=None):
+        super().__init__(0, run_id, config, started_first, 0, verbose, test_yaml=test_yaml,
+                         compression_workers=compression_workers, policy=policy, binding=False,
+                         timeout_factor=timeout_factor, min_timeout=min_timeout, events_socket=events_socket)
+        self.address = address
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.workers = set()
+        # workers may declare their memory
+        self._estimate_memory()
+
+    def _start_job(self, job):
+        self.print(f"[{job.test_id}][Step {job.step}] Started on {job.worker.name}")
+        view = job.worker
+        view.available_cores -= job.num_cores()
+        if view.available_memory is not None:
+            view.available_memory -= job.memory
+        job.start_time = self.clock()
+        view.running_tests[(job.test_id,job.step)] = job
+        self.running_tests[(job.test_id,job.step)] = job
+        self._job_started(job)
+
+    def _release(self, job):
+        view = job.worker
+        view.available_cores += job.num_cores()
+        if view.available_memory is not None:
+            view.available_memory += job.memory
+        del view.running_tests[(job.test_id,job.step)]
+        del self.running_tests[(job.test_id,job.step)]
+
+    def _capacity(self):
+        return sum(v.available_cores + sum(j.num_cores() for j in v.running_tests.values()) for v in self.workers)
+
+    def _kill(self, job, status):
+        # workers kill their jobs when they are told the run is cancelled
+        pass
+
+    def _check_finished(self):
+        if self.cancelled and not self.running_tests:
+            self.finished.set()
+            return
+        if not self.running_tests and not self.ready:
+            self._refresh()
+            if not self.ready:
+                self.finished.set()
+
+    def request_job(self, view):
+        if self.cancelled:
+            self._check_finished()
+            return {"done" : True, "cancel" : True}
+        job = self._nextjob(view)
+        if job is None:
+            self._check_finished()
+            return {"done" : True} if self.finished.is_set() else {"job" : None}
+        job.worker = view
+        self._start_job(job)
+        return {"job" : job.to_dict()}
+
+    def end_job(self, view, request):
+        job = view.running_tests[(request["test_id"], request["step"])]
+        job.return_code = request["status"]
+        job.usage = request["usage"]
+        self._end_job(job)
+        self._check_finished()
+        return {}
+
+    def disconnect(self, view):
+        """Jobs of a lost worker are ready again."""
+        self.workers.discard(view)
+        for key, job in list(view.running_tests.items()):
+            if self.cancelled:
+                job.return_code = jobrunner.exit_cancelled
+                self._end_job(job)
+                continue
+            print(f"[{job.test_id}][Step {job.step}] Lost with worker {view.name}, rescheduled")
+            self._release(job)
+            db.release_task(job.test_id_db, job.step, self.runner)
+            self.ready.add(key)
+        self._check_finished()
+
+    def run(self):
+        """ Serve jobs until all of them are completed. """
+        self._start_services()
+        with _Server(self.address, _Handler) as server:
+            server.coordinator = self
+            threading.Thread(name="coordinator", target=server.serve_forever, daemon=True).start()
+            print(f"Serving run {self.run_id} on {self.address[0]}:{self.address[1]}", flush=True)
+            with self.lock:
+                self._check_finished()
+            while not self.finished.wait(jobrunner.refresh_interval):
+                with self.lock:
+                    self._check_cancel()
+                    self._check_finished()
+            server.shutdown()
+        self._stop_services()
+
+class Worker(jobrunner.Supervisor):
+    """Runs the jobs handed out by a Coordinator on num_cores cores of this node."""
+    def __init__(self, address, num_cores, verbose, binding=True, max_memory=None):
+        super().__init__(num_cores, verbose, binding, max_memory)
+        self.address = address
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+
+    def run(self):
+        """ Run jobs until the coordinator has no more of them. """
+        with socket.create_connection(self.address) as sock, sock.makefile("rw") as stream:
+            def request(message):
+                stream.write(json.dumps(message) + "\n")
+                stream.flush()
+                reply = stream.readline()
+                if not reply:
+                    raise ConnectionError("connection closed by the coordinator")
+                return json.loads(reply)
+
+            hello = request({"request" : "hello", "name" : self.name, "cores" : self.num_cores,
+                             "memory" : self.available_memory})
+            # the results directory is expected to be shared with the coordinator
+            os.chdir(hello["directory"])
+            # metrics of the jobs are spooled in their directory, and recorded by the
+            # coordinator when they end (see JobRunner._end_job)
+            os.environ["GCVB_SPOOL_METRICS"] = "1"
+            self._open_selector()
+            done = False
+            try:
+                while not done or self.running_tests:
+                    while not done:
+                        reply = request({"request" : "job"})
+                        done = reply.get("done", False)
+                        if reply.get("cancel"):
+                            self._kill_all(jobrunner.exit_cancelled)
+                        if not reply.get("job"):
+                            break
+                        self._start_job(jobrunner.Job.from_dict(reply["job"]))
+                    for job in self._wait_jobs(worker_poll_interval):
+                        self.print(f"[{job.test_id}][Step {job.step}] Completed (return code : {job.return_code})")
+                        self._release(job)
+                        request({"request" : "end", "test_id" : job.test_id, "step" : job.step,
+                                 "status" : job.return_code, "usage" : job.usage})
+            except ConnectionError:
+                if self.running_tests:
+                    raise
+            finally:
+                self._close_selector()
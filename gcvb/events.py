@@ -0,0 +1,132 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+follow_interval = 0.2 # seconds, delay between two reads of an idle event log
+subscriber_backlog = 1000 # events waiting for a socket client, which is disconnected beyond
+
+def log_path(computation_dir, run_id):
+    """Events of a run are appended by all its jobrunners to the same file."""
+    return os.path.join(computation_dir, f"events_{run_id}.jsonl")
+
+class _Subscriber(socketserver.StreamRequestHandler):
+    """Sends the events queued by emit, in the thread of the connection :
+       a client which does not read never blocks the jobrunner."""
+    def handle(self):
+        log = self.server.log
+        self.queue = queue.Queue(subscriber_backlog)
+        self.thread = threading.current_thread()
+        with log.lock:
+            log.subscribers.append(self)
+        try:
+            for line in iter(self.queue.get, None):
+                self.wfile.write(line)
+                self.wfile.flush()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with log.lock:
+                if self in log.subscribers:
+                    log.subscribers.remove(self)
+
+    def disconnect(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+class EventLog(object):
+    """
+    JSON lines log of the events of a jobrunner. Each event is a dict with at least
+    "event" (its type) and "time" (seconds since the epoch).
+
+    Events are also sent to the clients connected to the Unix socket socket_path, if given.
+    """
+    def __init__(self, path, socket_path=None):
+        # one write per event : lines of concurrent jobrunners are not interleaved
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.server = None
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.server = _Server(socket_path, _Subscriber)
+            self.server.log = self
+            threading.Thread(name="events", target=self.server.serve_forever, daemon=True).start()
+
+    def emit(self, event, **fields):
+        line = (json.dumps({"event" : event, "time" : time.time(), **fields}) + "\n").encode()
+        with self.lock:
+            os.write(self.fd, line)
+            for s in list(self.subscribers):
+                try:
+                    s.queue.put_nowait(line)
+                except queue.Full:
+                    # too slow, its pending write fails
+                    self.subscribers.remove(s)
+                    s.disconnect()
+
+    def close(self):
+        os.close(self.fd)
+        if self.server:
+            with self.lock:
+                subscribers = list(self.subscribers)
+                for s in subscribers:
+                    try:
+                        s.queue.put_nowait(None)
+                    except queue.Full:
+                        s.disconnect()
+            # pending events are sent for a second at most
+            for s in subscribers:
+                s.thread.join(1)
+                s.disconnect()
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.server.server_address)
+
+def follow(path, timeout=None):
+    """Yields the events of a log, waiting for new ones like tail -f.
+       Returns after timeout seconds without event."""
+    last = time.monotonic()
+    with open(path) as f:
+        buffer = ""
+        while True:
+            line = f.readline()
+            if line:
+                buffer += line
+                if buffer.endswith("\n"):
+                    last = time.monotonic()
+                    yield json.loads(buffer)
+                    buffer = ""
+                continue
+            if timeout is not None and time.monotonic() - last > timeout:
+                return
+            time.sleep(follow_interval)
+
+def last_event(path, event=None):
+    """Returns the last event of a log (of type event if given), or None."""
+    if not os.path.exists(path):
+        return None
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        # only the end of the log is read
+        f.seek(max(0, size - 65536))
+        lines = f.read().splitlines()
+    if size > 65536:
+        lines = lines[1:] # partial line
+    for line in reversed(lines):
+        try:
+            e = json.loads(line)
+        except ValueError:
+            continue
+        if event is None or e["event"] == event:
+            return e
+    return None
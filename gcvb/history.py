@@ -0,0 +1,123 @@
+import array
+import csv
+import re
+import threading
+from . import db
+
+def _new_columns():
+    # runs, values. numpy.asarray uses their buffer without copy.
+    return array.array("q"), array.array("d")
+
+def retrieve_histories(pairs, since_run=0):
+    """Return the history of many metrics with a single query.
+
+    Keyword arguments:
+    pairs     -- iterable of (test name, metric id)
+    since_run -- only runs with a greater id are read
+
+    Returns a dict {(test, metric) : (runs, values)} of columns ordered by run id,
+    NULL values are NaN.
+    """
+    pairs = list(pairs)
+    res = {p : _new_columns() for p in pairs}
+    for test, metric, run, value in db.retrieve_histories(pairs, since_run):
+        runs, values = res[(test, metric)]
+        runs.append(run)
+        # NULL for an empty series
+        values.append(value if value is not None else float("nan"))
+    return res
+
+class HistoryCache:
+    """Keep histories in memory and only read runs newer than the cached ones.
+
+    Only runs that will not change anymore (see db.get_last_stable_run) are
+    cached, metrics of runs in progress are read at each call.
+    Safe to share between threads (the dashboard server is threaded).
+    """
+    def __init__(self):
+        self.columns = {}
+        self.cached_until = {}
+        self.lock = threading.Lock()
+
+    def get(self, pairs):
+        """Same as retrieve_histories(pairs)"""
+        # concurrent requests would both append the runs read since the same until
+        with self.lock:
+            return self._get(list(pairs))
+
+    def _get(self, pairs):
+        stable = db.get_last_stable_run()
+        since = min([self.cached_until.get(p, 0) for p in pairs], default=0)
+        res = {}
+        new = retrieve_histories(pairs, since)
+        for p in pairs:
+            cached_runs, cached_values = self.columns.setdefault(p, _new_columns())
+            until = self.cached_until.get(p, 0)
+            runs, values = array.array("q", cached_runs), array.array("d", cached_values)
+            for run, value in zip(*new[p]):
+                if run <= until:
+                    continue
+                if run <= stable:
+                    cached_runs.append(run)
+                    cached_values.append(value)
+                runs.append(run)
+                values.append(value)
+            self.cached_until[p] = max(until, stable)
+            res[p] = (runs, values)
+        return res
+
+    def clear(self):
+        with self.lock:
+            self.columns = {}
+            self.cached_until = {}
+
+cache = HistoryCache()
+
+def export(filename, test_regexp=None, since_run=0):
+    """Export the history of every metric in a columnar file.
+
+    Keyword arguments:
+    filename    -- .csv, or .parquet (requires pyarrow)
+    test_regexp -- only export tests whose name matches
+    since_run   -- only export runs with a greater id
+
+    Returns the number of exported values.
+    """
+    rows = db.iter_history(since_run)
+    if test_regexp:
+        rows = (r for r in rows if re.match(test_regexp, r[0]))
+    if filename.endswith(".parquet"):
+        return _export_parquet(filename, rows)
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["test", "metric", "run", "value"])
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+def _export_parquet(filename, rows, batch_size=100000):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("parquet export requires the 'pyarrow' package (pip install gcvb[export])")
+    schema = pyarrow.schema([("test", pyarrow.string()), ("metric", pyarrow.string()),
+                             ("run", pyarrow.int64()), ("value", pyarrow.float64())])
+    def to_batch(batch):
+        columns = [pyarrow.array(c, type=t) for c, t in zip(zip(*batch), schema.types)]
+        return pyarrow.record_batch(columns, schema=schema)
+    count = 0
+    with pyarrow.parquet.ParquetWriter(filename, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                writer.write_batch(to_batch(batch))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_batch(to_batch(batch))
+            count += len(batch)
+    return count
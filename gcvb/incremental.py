@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import shlex
+import shutil
+from . import db
+from . import util
+from . import jobrunner
+
+# (path, size, mtime) -> sha256, files are only read once per process
+_digests = {}
+
+def file_digest(path):
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if key not in _digests:
+        _digests[key] = util.hash_file(path)
+    return _digests[key]
+
+def data_digest(data_root, data):
+    """Digest of every file of a data directory (inputs, templates and references)."""
+    key = ("data", data_root, data)
+    if key not in _digests:
+        h = hashlib.sha256()
+        data_dir = os.path.join(data_root, data)
+        for root, dirs, files in os.walk(data_dir, followlinks=True):
+            dirs.sort()
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                h.update(os.path.relpath(path, data_dir).encode() + b"\0" + file_digest(path).encode())
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+def command_files(command, cwd):
+    """Files a command depends on : the paths it is given (absolute or relative to cwd)
+       and every word naming a program on PATH (launchers such as mpirun included)."""
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        tokens = command.split()
+    files = []
+    for token in tokens:
+        if os.sep in token:
+            path = os.path.join(cwd, token)
+        else:
+            path = shutil.which(token)
+        if path and os.path.isfile(path) and path not in files:
+            files.append(path)
+    return files
+
+def fingerprint(job, test, data_root, cwd):
+    """Digest of what the result of a job depends on.
+
+    Keyword arguments:
+    job       -- jobrunner.Job
+    test      -- test description (from tests.yaml)
+    data_root -- directory of the data of the tests
+    cwd       -- directory of the test
+    """
+    h = hashlib.sha256()
+    h.update(job.launch_command.encode() + b"\0")
+    h.update(json.dumps(test.get("template_instantiation", {}), sort_keys=True, default=str).encode() + b"\0")
+    # paths are already in the command, only the content is added
+    files = command_files(job.launch_command, cwd)
+    # the executable may only appear in the command through a template
+    files += [f for f in command_files(job.executable or "", cwd) if f not in files]
+    for path in files:
+        h.update(file_digest(path).encode() + b"\0")
+    if "data" in test:
+        h.update(data_digest(data_root, test["data"]).encode())
+    return h.hexdigest()
+
+def reuse_unchanged(run_id, config, test_yaml, computation_dir):
+    """Record the fingerprints of the tasks of a run. Tests whose tasks all have the
+       fingerprint of a successful previous test are completed with its metrics and files.
+       Returns the names of these tests.
+
+    Keyword arguments:
+    run_id    -- run, just created
+    config    -- configuration (as in config.yaml)
+    test_yaml -- content of tests.yaml
+    computation_dir -- directory of the base (results/<base id>)
+    """
+    tests, _ = jobrunner.load_jobs(run_id, config, test_yaml)
+    fingerprints = []
+    for name, tasks in tests.items():
+        for step, job in tasks.items():
+            fp = fingerprint(job, test_yaml["Tests"][name], test_yaml["data_root"],
+                             os.path.join(computation_dir, name))
+            fingerprints.append((fp, job.test_id_db, step))
+    db.set_fingerprints(fingerprints)
+    return db.copy_unchanged_tests(run_id)
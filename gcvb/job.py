@@ -5,6 +5,7 @@ from copy import copy
 from . import util
 from . import yaml_input
 from . import template
+from . import db
 
 
 def templates_to_files(test,template_path,target_dir):
@@ -60,7 +61,7 @@ def format_launch_command(format_string, config, at_job_creation):
     d={"@job_creation" : at_job_creation, "@executable" : executable}
     return format_string.format(**d)
 
-def fill_at_job_creation_task(at_job_creation, task, full_id, config, singularity):
+def fill_at_job_creation_task(at_job_creation, task, full_id, config, singularity=False):
     at_job_creation["nthreads"]=task["nthreads"]
     at_job_creation["nprocs"]=task["nprocs"]
     at_job_creation["full_id"]=full_id #test["id"]+"_"+str(c)
@@ -68,13 +69,14 @@ def fill_at_job_creation_task(at_job_creation, task, full_id, config, singularit
     if task["executable"] in config["executables"]:
         at_job_creation["executable"]=config["executables"][task["executable"]]
     at_job_creation["options"]=task.get("options","")
+    at_job_creation["cpuset"]="${GCVB_CPUSET}" # cores given by the jobrunner, expanded at launch
     if singularity:
         at_job_creation["singularity"]=" ".join(config["singularity"])
     else:
         at_job_creation["singularity"]=""
     return None
 
-def fill_at_job_creation_validation(at_job_creation, validation, data_root, ref_data, config, valid, singularity):
+def fill_at_job_creation_validation(at_job_creation, validation, data_root, ref_data, config, valid, singularity=False):
     at_job_creation["va_id"]=validation["id"]
     at_job_creation["va_executable"]=validation["executable"]
     if validation["type"]=="file_comparison":
@@ -95,6 +97,7 @@ def fill_at_job_creation_validation(at_job_creation, validation, data_root, ref_
         at_job_creation["va_executable"]=config["executables"][validation["executable"]]
     at_job_creation["nprocs"]=validation.get("nprocs","1") # should we default to one or impose definition ?
     at_job_creation["nthreads"]=validation.get("nthreads","1")
+    at_job_creation["cpuset"]="${GCVB_CPUSET}"
     if singularity:
         at_job_creation["singularity"]=" ".join(config["singularity"])
     else:
@@ -116,6 +119,8 @@ def write_script(tests, config, data_root, base_id, run_id, *, job_file="job.sh"
                 for line in h:
                     f.write(line)
             f.write("\n")
+        if db.use_journal():
+            f.write("export GCVB_DB_MODE=journal\n")
         f.write(singularity_prefix + "python3 -m gcvb db start_run {0} -1 -1 \n".format(run_id))
         f.write("cd results/{0}\n".format(str(base_id)))
         for test in tests:
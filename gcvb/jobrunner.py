@@ -1,21 +1,40 @@
 #! /usr/bin/env python3
 
 import threading
-import bisect
+import queue
+import selectors
+import multiprocessing
+import concurrent.futures
 import random
 import subprocess
+import signal
+import shutil
 import os
 import sys
 import glob
+import socket
+import time
+import datetime
 from . import util
 from . import db
 from . import job as gcvb_job
 from . import yaml_input
+from . import user_lib
+from . import scheduler
+from . import events
 
 exit_success = 0
+exit_timeout = -5 # killed by the jobrunner after its timeout
+exit_cancelled = -6 # not run or killed because of gcvb cancel
+lease_duration = 300 # seconds, a claimed task is released if its runner does not renew it
+refresh_interval = 5 # seconds, minimum delay between two polls of the db for tasks made ready elsewhere
+poll_interval = 0.01 # seconds, only used where processes cannot be waited with a selector
+db_retry_interval = 1 # seconds, delay before a failed db write is retried
+db_retries = 10 # failed attempts of the last db writes before the jobrunner gives up
+taskset = shutil.which("taskset") # binds jobs before they start (see Job.start)
 
 class Job(object):
-    def __init__(self, run_id, test_id, test_id_db, step, launch_command, num_process, num_threads, job_type):
+    def __init__(self, run_id, test_id, test_id_db, step, launch_command, num_process, num_threads, job_type, memory=None, timeout=None):
         self.run_id = run_id
         self.test_id = test_id
         self.test_id_db = test_id_db
@@ -24,200 +43,613 @@ class Job(object):
         self.num_process = int(num_process)
         self.num_threads = int(num_threads)
         self.type = job_type
+        self.memory = util.parse_memory(memory) if memory is not None else None # bytes, None if unknown
+        self.usage = None
+        self.timeout = util.parse_duration(timeout) if timeout is not None else None # seconds
+        self.killed_status = None
         self.is_first = False
         self.is_last = False
         self.is_valid = False
+        self.executable = None # as resolved from config.yaml (see incremental.fingerprint)
         self.return_code = -1
+        self.process = None
+        self.start_time = None
+        self.cpuset = None
     def num_cores(self):
         return self.num_process*self.num_threads
-    def run(self):
+    def start(self, cpuset=None):
+        """Start the job, bound to the cores of cpuset if given."""
         env = dict(os.environ)
         env["GCVB_RUN_ID"] = f"{self.run_id}"
         env["GCVB_TEST_ID"] = f"{self.test_id_db}"
         env["GCVB_STEP_ID"] = f"{self.step}"
-        self.return_code = subprocess.call(self.launch_command, shell=True, cwd=self.test_id, env=env)
+        args = self.launch_command
+        self.cpuset = cpuset
+        if cpuset:
+            env["GCVB_CPUSET"] = util.format_cpulist(cpuset)
+            env["OMP_PLACES"] = ",".join(f"{{{c}}}" for c in cpuset)
+            # not with preexec_fn, which may deadlock the child while other threads run
+            if taskset:
+                args = [taskset, "-c", env["GCVB_CPUSET"], "/bin/sh", "-c", self.launch_command]
+        # own process group, so that everything started by the job can be killed
+        self.process = subprocess.Popen(args, shell=isinstance(args, str), cwd=self.test_id, env=env,
+                                        start_new_session=True)
+        if cpuset and not taskset:
+            # processes started by the job before this call are not bound
+            try:
+                os.sched_setaffinity(self.process.pid, cpuset)
+            except ProcessLookupError:
+                pass
+        return self.process
+    def run(self):
+        self.start()
+        self.return_code = self.process.wait()
+    def to_dict(self):
+        return {"run_id" : self.run_id, "test_id" : self.test_id, "test_id_db" : self.test_id_db, "step" : self.step,
+                "launch_command" : self.launch_command, "num_process" : self.num_process,
+                "num_threads" : self.num_threads, "job_type" : self.type, "memory" : self.memory,
+                "timeout" : self.timeout}
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        memory = d.pop("memory")
+        job = cls(**d)
+        job.memory = memory
+        return job
     def name(self):
         return f"{self.test_id}_{self.num_process}x{self.num_threads}_{self.type}"
     def __repr__(self):
         return self.name()
 
-class JobRunner(object):
-    def __init__(self, num_cores, run_id, config, started_first, max_concurrent, verbose, test_yaml=None):
+def _prepare_blob(filename):
+    """Executed in the compression pool. Returns the arguments expected by db.save_blobs
+       (except the test id). Identical files are only compressed once."""
+    h = util.hash_file(filename)
+    compressed = None
+    if not db.get_known_blobs([h]):
+        compressed = db.compress_for_storage(filename)
+    return os.path.basename(filename), h, compressed
+
+def pidfd_supported():
+    """os.pidfd_open may exist but fail : ENOSYS on old kernels, EPERM under seccomp.
+       Jobs are then polled with os.wait4 (see Supervisor._wait_jobs)."""
+    if not hasattr(os, "pidfd_open"):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return False
+    return True
+
+def numa_nodes():
+    """Returns the cores this process may use, grouped by NUMA node."""
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    paths = glob.glob("/sys/devices/system/node/node*/cpulist")
+    for path in sorted(paths, key = lambda p: int(os.path.basename(os.path.dirname(p))[4:])):
+        with open(path) as f:
+            cpus = allowed.intersection(util.parse_cpulist(f.read()))
+        if cpus:
+            nodes.append(cpus)
+    others = allowed.difference(*nodes)
+    if others:
+        nodes.append(others)
+    return nodes
+
+class CoreAllocator(object):
+    """Gives disjoint sets of cores to jobs, within a NUMA node when possible."""
+    def __init__(self, num_cores, nodes):
+        self.free = []
+        for node in nodes:
+            cpus = sorted(node)[:num_cores]
+            num_cores -= len(cpus)
+            if cpus:
+                self.free.append(set(cpus))
+        self.node_of = {c : n for n, node in enumerate(self.free) for c in node}
+    def allocate(self, num_cores):
+        fitting = [node for node in self.free if len(node) >= num_cores]
+        if fitting:
+            # the fullest node where the job fits, to keep whole nodes for large jobs
+            node = min(fitting, key=len)
+            cpus = sorted(node)[:num_cores]
+        else:
+            # spread over the nodes with the most free cores
+            cpus = []
+            for node in sorted(self.free, key=len, reverse=True):
+                cpus.extend(sorted(node)[:num_cores-len(cpus)])
+        for c in cpus:
+            self.free[self.node_of[c]].discard(c)
+        return cpus
+    def release(self, cpus):
+        for c in cpus:
+            self.free[self.node_of[c]].add(c)
+
+def load_jobs(run_id, config, test_yaml):
+    """Returns the jobs of a run indexed by test name and step, and the files to keep by test name."""
+    keep = {}
+    test_informations = test_yaml["Tests"]
+    tests_for_current_run = db.get_tests(run_id)
+
+    data_root = test_yaml["data_root"]
+    tests = {t["name"] : {} for t in tests_for_current_run}
+    test_id_in_db = {t["name"] : t["id"] for t in tests_for_current_run}
+    test_list = list(tests.keys())
+    ref_valid = yaml_input.get_references([test_informations[n] for n in test_list],data_root)
+    for test,tasks in tests.items():
+        current_test = test_informations[test]
+        if 'keep' in current_test:
+            keep[current_test['id']] = current_test['keep']
+        step = 0
+        for c, task in enumerate(current_test["Tasks"]):
+            step += 1
+            at_job_creation = {}
+            gcvb_job.fill_at_job_creation_task(at_job_creation, task, f"{current_test['id']}_{c}", config)
+            launch_command = gcvb_job.format_launch_command(task["launch_command"],
+                                                            config, at_job_creation)
+            j=Job(run_id, test, test_id_in_db[test], step, launch_command,
+                      at_job_creation["nprocs"], at_job_creation["nthreads"], "task", task.get("memory"), task.get("timeout"))
+            j.executable = at_job_creation["executable"]
+            tasks[step] = j
+            for d, val in enumerate(task.get("Validations",[])):
+                step += 1
+                gcvb_job.fill_at_job_creation_validation(at_job_creation, val,
+                                                         data_root, current_test["data"], config, ref_valid)
+                launch_command = gcvb_job.format_launch_command(val["launch_command"],
+                                                                config, at_job_creation)
+                j = Job(run_id, test, test_id_in_db[test], step, launch_command,
+                        at_job_creation["nprocs"], at_job_creation["nthreads"], "validation", val.get("memory"),
+                        val.get("timeout"))
+                j.is_valid = True
+                j.executable = at_job_creation["va_executable"]
+                tasks[step] = j
+        tasks[1].is_first = True
+        tasks[step].is_last = True
+    return tests, keep
+
+def load_children(run_id):
+    """Returns the steps depending on each (test name, step) and the ready tasks of a run."""
+    children = {}
+    ready = set()
+    for t in db.get_tasks(run_id):
+        if t["parent"] is not None:
+            children.setdefault((t["name"], t["parent"]), []).append(t["step"])
+        if t["status"] == -2:
+            ready.add((t["name"], t["step"]))
+    return children, ready
+
+class Supervisor(object):
+    """Runs jobs as children of this process, within num_cores cores (and max_memory if given)."""
+    def __init__(self, num_cores, verbose, binding=True, max_memory=None):
         self.num_cores = num_cores
         self.running_tests = {}
-        self.condition = threading.Condition()
         self.available_cores = num_cores
-        self.lock = threading.Lock()
+        self.available_memory = util.parse_memory(max_memory) if max_memory is not None else None
+        self.selector = None
+        self.verbose = verbose
+        # Jobs are bound to their own cores, unless there are less cores than requested.
+        self.cores = None
+        if binding and hasattr(os, "sched_getaffinity") and len(os.sched_getaffinity(0)) >= num_cores:
+            self.cores = CoreAllocator(num_cores, numa_nodes())
+
+    def clock(self):
+        return time.monotonic()
+
+    def _open_selector(self):
+        if pidfd_supported():
+            self.selector = selectors.DefaultSelector()
+
+    def _close_selector(self):
+        if self.selector:
+            self.selector.close()
+
+    def _start_job(self, job):
+        self.print(f"[{job.test_id}][Step {job.step}] Started")
+        self.print(f"[{job.test_id}][Step {job.step}] cmd : {job.launch_command}")
+        self.available_cores -= job.num_cores()
+        if self.available_memory is not None:
+            self.available_memory -= job.memory
+        job.start_time = self.clock()
+        job.start(self.cores.allocate(job.num_cores()) if self.cores else None)
+        self.running_tests[(job.test_id,job.step)] = job
+        if self.selector:
+            self.selector.register(os.pidfd_open(job.process.pid), selectors.EVENT_READ, job)
+
+    def _kill(self, job, status):
+        """Kill the process group of a running job, it is then reaped with status."""
+        job.killed_status = status
+        try:
+            os.killpg(job.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _kill_all(self, status):
+        for job in self.running_tests.values():
+            if job.killed_status is None:
+                self._kill(job, status)
+
+    def _check_timeouts(self):
+        """Kill the jobs running for longer than their timeout. Returns the delay until the next timeout."""
+        next_timeout = float("inf")
+        now = self.clock()
+        for job in list(self.running_tests.values()):
+            if job.timeout is None or job.killed_status is not None:
+                continue
+            left = job.start_time + job.timeout - now
+            if left <= 0:
+                print(f"[{job.test_id}][Step {job.step}] Killed after its timeout ({job.timeout:.0f}s)", file=sys.stderr)
+                self._kill(job, exit_timeout)
+            else:
+                next_timeout = min(next_timeout, left)
+        return next_timeout
+
+    def _wait_jobs(self, timeout):
+        """Block until at least one job completes or timeout expires. Returns completed jobs."""
+        timeout = min(timeout, self._check_timeouts())
+        if self.selector:
+            # a pidfd is readable once the process terminated, other children (like the
+            # compression pool workers) are left alone unlike os.waitpid(-1).
+            completed = []
+            for key, _ in self.selector.select(timeout):
+                self.selector.unregister(key.fd)
+                os.close(key.fd)
+                self._reap(key.data, 0)
+                completed.append(key.data)
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                completed = [j for j in list(self.running_tests.values()) if self._reap(j, os.WNOHANG)]
+                if completed or time.monotonic() > deadline:
+                    break
+                time.sleep(poll_interval)
+        return completed
+
+    def _reap(self, job, options):
+        """Collect the exit status and the resource usage of a job. Returns False if it is still running."""
+        pid, status, rusage = os.wait4(job.process.pid, options)
+        if pid == 0:
+            return False
+        job.process.returncode = os.waitstatus_to_exitcode(status)
+        # killed by a signal : 128+signal, like $? in the job scripts
+        job.return_code = job.process.returncode if job.process.returncode >= 0 else 128 - job.process.returncode
+        if job.killed_status is not None:
+            job.return_code = job.killed_status
+        job.usage = {"user_time" : rusage.ru_utime, "system_time" : rusage.ru_stime,
+                     "max_rss" : rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+                     "voluntary_switches" : rusage.ru_nvcsw, "involuntary_switches" : rusage.ru_nivcsw,
+                     # blocks of 512 bytes, actual reads and writes to storage (not the page cache)
+                     "read_bytes" : rusage.ru_inblock * 512, "write_bytes" : rusage.ru_oublock * 512}
+        return True
+
+    def _release(self, job):
+        """Give back the resources of a completed job."""
+        self.available_cores += job.num_cores()
+        if self.available_memory is not None:
+            self.available_memory += job.memory
+        if job.cpuset:
+            self.cores.release(job.cpuset)
+        del self.running_tests[(job.test_id,job.step)]
+
+    def print(self, *objects, sep=' ', end='\n', file=sys.stdout, flush=False):
+        if self.verbose:
+          print(*objects, sep=sep, end=end, file=file, flush=flush)
+
+class JobRunner(Supervisor):
+    def __init__(self, num_cores, run_id, config, started_first, max_concurrent, verbose, test_yaml=None, compression_workers=2,
+                 policy=None, binding=True, max_memory=None, timeout_factor=None, min_timeout=60,
+                 events_socket=None):
+        super().__init__(num_cores, verbose, binding, max_memory)
         self.started_first = started_first
         self.max_concurrent = max_concurrent # 0 means unlimited
-        self.verbose = verbose
-        self.keep = {}
         self.run_id = run_id
         self.base_id = db.get_base_from_run(run_id)
         computation_dir = f"./results/{self.base_id}"
         self.config = config
+        db.get_compression() # check the configuration before running anything
+        self.compression_workers = compression_workers
+        self.compression_pool = None
+        self.db_writes = queue.Queue()
+        self.runner = f"{socket.gethostname()}:{os.getpid()}"
+        self.last_refresh = 0.
+        self.cancelled = False
+        self.last_cancel_check = 0.
+        self.policy = policy or scheduler.CoresPolicy()
+        self.events = None
+        self.events_socket = events_socket
 
         # Generate job list
         if test_yaml is None:
             test_yaml = yaml_input.load_yaml(os.path.join(computation_dir,"tests.yaml"))
-        test_informations = test_yaml["Tests"]
-        tests_for_current_run = db.get_tests(self.run_id)
-
-        data_root = test_yaml["data_root"]
-        self.tests = {t["name"] : {} for t in tests_for_current_run}
-        test_id_in_db = {t["name"] : t["id"] for t in tests_for_current_run}
-        test_list = list(self.tests.keys())
-        ref_valid = yaml_input.get_references([test_informations[n] for n in test_list],data_root)
-        for test,tasks in self.tests.items():
-            current_test = test_informations[test]
-            if 'keep' in current_test:
-                self.keep[current_test['id']] = current_test['keep']
-            step = 0
-            for c, task in enumerate(current_test["Tasks"]):
-                step += 1
-                at_job_creation = {}
-                gcvb_job.fill_at_job_creation_task(at_job_creation, task, f"{current_test['id']}_{c}", self.config)
-                launch_command = gcvb_job.format_launch_command(task["launch_command"],
-                                                                self.config, at_job_creation)
-                j=Job(self.run_id, test, test_id_in_db[test], step, launch_command,
-                          at_job_creation["nprocs"], at_job_creation["nthreads"], "task")
-                tasks[step] = j
-                for d, val in enumerate(task.get("Validations",[])):
-                    step += 1
-                    gcvb_job.fill_at_job_creation_validation(at_job_creation, val,
-                                                             data_root, current_test["data"], config, ref_valid)
-                    launch_command = gcvb_job.format_launch_command(val["launch_command"],
-                                                                    self.config, at_job_creation)
-                    j = Job(self.run_id, test, test_id_in_db[test], step, launch_command,
-                            at_job_creation["nprocs"], at_job_creation["nthreads"], "validation")
-                    j.is_valid = True
-                    tasks[step] = j
-            tasks[1].is_first = True
-            tasks[step].is_last = True
+        self.tests, self.keep = load_jobs(self.run_id, self.config, test_yaml)
+        if self.available_memory is not None:
+            self._estimate_memory()
+
+        if timeout_factor:
+            self._default_timeouts(timeout_factor, min_timeout)
 
+        # The task graph is kept in memory, the db is only polled for tasks made ready by other runners.
+        self.children, self.ready = load_children(self.run_id)
 
         # Go to the right directory
         os.chdir(computation_dir)
         # Then choose the right location for the db
         db.set_db(os.path.abspath("../../gcvb.db"))
 
-    def _run_job(self, job):
-        self.print(f"[{job.test_id}][Step {job.step}] Started")
-        self.print(f"[{job.test_id}][Step {job.step}] cmd : {job.launch_command}")
-        job.run()
+    def _estimate_memory(self):
+        """Jobs without memory requirement are expected to use as much as in previous runs."""
+        peak = db.get_peak_memory(self.run_id - 1)
+        for test, tasks in self.tests.items():
+            for step, j in tasks.items():
+                if j.memory is None:
+                    j.memory = peak.get((test, step), 0)
+
+    def _default_timeouts(self, factor, min_timeout):
+        """Jobs without timeout may last factor times their median duration in previous runs (at least min_timeout)."""
+        durations, _ = scheduler.expected_durations(self.run_id)
+        for test, tasks in self.tests.items():
+            for step, j in tasks.items():
+                if j.timeout is None and (test, step) in durations:
+                    j.timeout = max(min_timeout, factor * durations[(test, step)])
+
+    def _check_cancel(self):
+        """Stop everything once the run is cancelled (see db.cancel_run)."""
+        if self.cancelled or time.monotonic() - self.last_cancel_check < refresh_interval:
+            return
+        self.last_cancel_check = time.monotonic()
+        if db.is_cancelled(self.run_id):
+            print(f"Run {self.run_id} cancelled.", file=sys.stderr)
+            self._emit("run_cancelled")
+            self.cancelled = True
+            self.ready.clear()
+            self._kill_all(exit_cancelled)
+
+    def _prepare_progress(self):
+        """Expected work (in core-seconds) of the tasks not started yet, for the ETA of the events."""
+        self.durations, self.default_duration = scheduler.expected_durations(self.run_id)
+        self.unstarted = {(t["name"], t["step"]) for t in db.get_tasks(self.run_id) if t["status"] in (-3, -2)}
+        self.pending_work = sum(self._work(self.tests[t][s]) for t, s in self.unstarted)
+
+    def _expected_duration(self, job):
+        return self.durations.get((job.test_id, job.step), self.default_duration)
+
+    def _work(self, job):
+        return self._expected_duration(job) * job.num_cores()
+
+    def _forget(self, test, steps):
+        """Steps that will not be run by this runner are no longer part of the ETA."""
+        for step in steps:
+            if (test, step) in self.unstarted:
+                self.unstarted.discard((test, step))
+                self.pending_work -= self._work(self.tests[test][step])
+
+    def _capacity(self):
+        return self.num_cores
+
+    def _emit(self, event, **fields):
+        """Publish an event with the current load of the runner (see events.EventLog)."""
+        if self.events is None:
+            return
+        now = self.clock()
+        running = self.running_tests.values()
+        work = self.pending_work + sum(max(0., j.start_time + self._expected_duration(j) - now) * j.num_cores()
+                                       for j in running)
+        capacity = self._capacity()
+        self.events.emit(event, run_id=self.run_id, runner=self.runner, **fields,
+                         cores=capacity, cores_in_use=sum(j.num_cores() for j in running),
+                         running=len(self.running_tests), ready=len(self.ready),
+                         eta=work / capacity if capacity else None)
+
+    def _start_job(self, job):
+        super()._start_job(job)
+        self._job_started(job)
+
+    def _job_started(self, job):
+        self._forget(job.test_id, [job.step])
+        self._emit("job_started", test=job.test_id, step=job.step)
+
+    def _end_job(self, job):
         self.print(f"[{job.test_id}][Step {job.step}] Completed (return code : {job.return_code})")
         # A test is stopped only if a Task fails (Validation failures do not matter)
         stopped_by_error = job.return_code != exit_success if not(job.is_valid) else False
-        with self.lock:
-            self.available_cores += job.num_cores()
-            del self.running_tests[(job.test_id,job.step)]
-
-            conn = db.get_exclusive_access()
-            with conn:
-                cursor = conn.cursor()
-                req = """UPDATE task
-                         SET end_date = CURRENT_TIMESTAMP, status = ?
-                         WHERE step = ? and test_id = ?"""
-                cursor.execute(req, [job.return_code, job.step, job.test_id_db])
-                if job.is_last or stopped_by_error:
-                    req = """UPDATE test
-                             SET end_date = CURRENT_TIMESTAMP
-                             WHERE id = ? and run_id = ?"""
-                    cursor.execute(req,[job.test_id_db,job.run_id])
-                    self.print(f"[{job.test_id}] Completed (Last return code : {job.return_code})")
-                if not(stopped_by_error):
-                    # Children are now ready
-                    req = """UPDATE task
-                             SET status = -2
-                             WHERE parent = ? and test_id = ?"""
-                    cursor.execute(req,[job.step, job.test_id_db])
-            conn.close()
+        stopped_by_error = stopped_by_error or job.return_code == exit_cancelled
+        spool = user_lib.spool_path(job.step, job.test_id)
+        metrics = user_lib.read_spool(spool)
+        self._release(job)
+        if not(stopped_by_error):
+            # Children are now ready
+            self.ready.update((job.test_id, c) for c in self.children.get((job.test_id, job.step), []))
+        if job.is_last or stopped_by_error:
+            self.print(f"[{job.test_id}] Completed (Last return code : {job.return_code})")
+        result = {"test_id" : job.test_id_db, "step" : job.step, "status" : job.return_code, "date" : db.now(),
+                  "metrics" : metrics, "end_test" : job.is_last or stopped_by_error,
+                  "children_ready" : not(stopped_by_error), "usage" : job.usage}
+        self.db_writes.put(("end", result, spool if metrics else None))
         if job.is_last or stopped_by_error:
             self.__save_files(job)
-        with self.condition:
-            self.condition.notify()
+        if stopped_by_error:
+            self._forget(job.test_id, self.tests[job.test_id])
+        self._emit("job_finished", test=job.test_id, step=job.step, status=job.return_code,
+                   duration=self.clock() - job.start_time, end_test=job.is_last or stopped_by_error)
 
     def __save_files(self, job):
         if job.test_id not in self.keep:
             return
-        # Read and compress without locking the db
-        tosave = []
+        # Hash and compress in the pool, the db writer saves them once they are ready.
+        futures = []
         for pattern in self.keep[job.test_id]:
             for filename in glob.iglob(os.path.join(job.test_id, pattern)):
-                content=util.file_to_compressed_binary(filename)
-                tosave.append((os.path.basename(filename), content, job.test_id_db,))
-        # Now lock the DB and save
-        db.save_blobs(tosave)
+                futures.append(self.compression_pool.submit(_prepare_blob, filename))
+        if not futures:
+            return
+        # queued once all of them are done : the db writer never waits for the pool
+        pending = [len(futures)]
+        lock = threading.Lock()
+        def done(future):
+            with lock:
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            self.db_writes.put(("files", job, futures))
+        for f in futures:
+            f.add_done_callback(done)
+
+    def _lease_until(self):
+        return db.now() + datetime.timedelta(seconds=lease_duration)
+
+    def _db_writer(self):
+        """Save task completions and kept files until None is received.
+           Pending completions are written in a single transaction.
+           Leases of running tasks are renewed meanwhile.
+           Failed writes (e.g. database locked) are retried. Once stopped, after
+           db_retries consecutive failures the error is kept in writer_error and
+           raised by _stop_services."""
+        renewed = time.monotonic()
+        stop = False
+        ends = []
+        failures = 0
+        while (not stop or ends) and self.writer_error is None:
+            items = []
+            try:
+                items.append(self.db_writes.get(timeout=db_retry_interval if ends else lease_duration/3))
+                while True:
+                    items.append(self.db_writes.get_nowait())
+            except queue.Empty:
+                pass
+            stop = stop or None in items
+            ends += [item for item in items if item is not None and item[0] == "end"]
+            try:
+                if time.monotonic() - renewed > lease_duration/3:
+                    db.renew_leases(self.runner, self._lease_until())
+                    renewed = time.monotonic()
+                if ends:
+                    db.end_tasks(self.run_id, [result for _, result, _ in ends])
+                    for _, _, spool in ends:
+                        if spool:
+                            os.remove(spool)
+                    ends = []
+                failures = 0
+            except Exception as e:
+                failures += 1
+                print(f"Database write failed, retried in {db_retry_interval}s : {e!r}", file=sys.stderr)
+                if stop and failures >= db_retries:
+                    self.writer_error = e
+            for item in items:
+                if item is None or item[0] != "files":
+                    continue
+                _, job, futures = item
+                tosave = [f.result() + (job.test_id_db,) for f in futures if f.exception() is None]
+                try:
+                    for f in futures:
+                        if f.exception() is not None:
+                            raise f.exception()
+                    db.save_blobs(tosave)
+                except Exception as e:
+                    print(f"[{job.test_id}] Kept files could not be saved : {e!r}", file=sys.stderr)
+                    # compressed files are consumed by save_blobs only
+                    for _, _, compressed, _ in tosave:
+                        if compressed is not None and os.path.exists(compressed[0]):
+                            os.remove(compressed[0])
+
+    def _start_services(self):
+        """Start the run, the compression pool and the db writer."""
+        db.start_run(self.run_id)
+        # spawn : workers may be started while job threads are running, fork is not safe then.
+        self.compression_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.compression_workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=db.set_db, initargs=(db.database,))
+        self.writer_error = None
+        self.writer = threading.Thread(name="db-writer", target=self._db_writer)
+        self.writer.start()
+        self.policy.prepare(self)
+        self._prepare_progress()
+        self.events = events.EventLog(events.log_path(".", self.run_id), self.events_socket)
+        self._emit("runner_started", tests=len(self.tests))
+
+    def _stop_services(self):
+        """Wait for pending db writes and end the run."""
+        # kept files are queued by the pool once compressed
+        self.compression_pool.shutdown()
+        self.db_writes.put(None)
+        self.writer.join()
+        db.merge_journal()
+        if self.writer_error is None:
+            db.end_run(self.run_id)
+        self._emit("runner_stopped", cancelled=self.cancelled)
+        self.events.close()
+        self.events = None
+        if self.writer_error is not None:
+            # completions are lost, the run must not look finished
+            raise self.writer_error
 
     def run(self):
         """  Run all submited jobs and block until finished. """
 
-        db.start_run(self.run_id)
-        job = self._nextjob()
-        while job is not None or len(self.running_tests) > 0:
-            if job is None:
-                with self.condition:
-                    self.condition.wait()
-            else:
-                with self.lock:
-                    self.available_cores -= job.num_cores()
-                    t = threading.Thread(name = job.name(), target = lambda: self._run_job(job))
-                    self.running_tests[(job.test_id,job.step)] = t
-                t.start()
-            job = self._nextjob()
-        db.end_run(self.run_id)
-
-    def elect_job(self, queue):
+        self._start_services()
+        # All jobs are started and reaped from this loop, db writes are left to the writer thread.
+        self._open_selector()
+        try:
+            while True:
+                self._check_cancel()
+                job = self._nextjob()
+                while job is not None:
+                    self._start_job(job)
+                    job = self._nextjob()
+                if not self.running_tests:
+                    break
+                # timeout : tasks may also be made ready by other runners
+                for job in self._wait_jobs(refresh_interval):
+                    self._end_job(job)
+        except BaseException:
+            # jobs have their own process group, they would survive a Ctrl-C
+            self._kill_all(exit_cancelled)
+            raise
+        finally:
+            self._close_selector()
+            self._stop_services()
+
+    def elect_job(self, queue, resources=None):
         """
-        Choose a job to run. Hack this function to change the strategy.
+        Choose a job to run. The strategy is given by the policy (see scheduler.Policy).
 
-        queue -- iterable of available jobs
+        queue     -- iterable of available jobs
+        resources -- where the job will run (default: this runner)
         """
-        queue = sorted(queue, key = lambda x: x.num_cores())
-        if len(self.running_tests) == 0:
-            # begin with a small job to detect errors early
-            return queue[0] if len(queue) else None
-        else:
-            # fill large jobs first to avoid starvation at the end
-            i = bisect.bisect([x.num_cores() for x in queue], self.available_cores) - 1
-            return queue[i] if i >= 0 else None
+        return self.policy.elect(resources or self, queue)
 
+    def _refresh(self):
+        """Add tasks made ready by other runners (or by expired leases) to the ready set."""
+        self.last_refresh = time.monotonic()
+        db.release_expired_leases(self.run_id)
+        for t in db.get_tasks(self.run_id):
+            key = (t["name"], t["step"])
+            if t["status"] == -2 and key not in self.running_tests:
+                self.ready.add(key)
 
+    def _nextjob(self, resources=None):
+        """Elect and claim a job which fits in resources (default: this runner)."""
+        resources = resources or self
+        if self.cancelled:
+            return None
+        # We don't take a job if we reached the max_concurrent limit
+        if self.max_concurrent and self.max_concurrent <= len(resources.running_tests):
+            return None
 
-    def _nextjob(self):
-        with self.lock:
-            # We don't take a job if we reached the max_concurrent limit
-            if self.max_concurrent and self.max_concurrent <= len(self.running_tests):
+        if not self.ready and (not self.running_tests or time.monotonic() - self.last_refresh > refresh_interval):
+            self._refresh()
+        while self.ready:
+            available_jobs = [self.tests[test][step] for test, step in self.ready]
+            if (self.started_first):
+              available_started_jobs = [j for j in available_jobs if j.step!=1]
+              available_jobs = available_started_jobs if available_started_jobs else available_jobs
+            if resources.available_memory is not None and resources.running_tests:
+                # a job larger than max_memory is only started alone
+                available_jobs = [j for j in available_jobs if j.memory <= resources.available_memory]
+            to_be_run = self.elect_job(available_jobs, resources)
+            if to_be_run is None:
                 return None
+            self.ready.discard((to_be_run.test_id, to_be_run.step))
+            # Another runner may have taken it since it was found ready.
+            if db.claim_task(self.run_id, to_be_run.test_id_db, to_be_run.step,
+                             self.runner, self._lease_until(), to_be_run.is_first):
+                return to_be_run
+        return None
 
-            # if we take elect an unstarted job, we must mark it as started while the database is locked for us.
-            # the elect process must be done with the lock on the database.
-            conn = db.get_exclusive_access()
-            with conn:
-                cursor = conn.cursor()
-                # Get ready tasks (status -2)
-                req = """SELECT step, test_id, name FROM task
-                         INNER JOIN test ON task.test_id=test.id
-                         INNER JOIN run ON run.id = test.run_id
-                         WHERE task.status = -2 AND run.id = ?"""
-                cursor.execute(req,[self.run_id])
-                available_jobs = [self.tests[test["name"]][test["step"]] for test in cursor.fetchall()]
-                if (self.started_first):
-                  available_started_jobs = [j for j in available_jobs if j.step!=1]
-                  available_jobs = available_started_jobs if available_started_jobs else available_jobs
-                to_be_run = self.elect_job(available_jobs)
-                if to_be_run and to_be_run.is_first: #was elected from database
-                    req = """UPDATE test SET start_date = CURRENT_TIMESTAMP
-                             WHERE id = ? and run_id = ?"""
-                    cursor.execute(req,[to_be_run.test_id_db,to_be_run.run_id])
-                if to_be_run:
-                    req = """UPDATE task
-                             SET start_date = CURRENT_TIMESTAMP, status = -1
-                             WHERE step = ? AND test_id = ?"""
-                    cursor.execute(req,[to_be_run.step, to_be_run.test_id_db])
-            conn.close()
-            return to_be_run
-
-    def print(self, *objects, sep=' ', end='\n', file=sys.stdout, flush=False):
-        if self.verbose:
-          print(*objects, sep=sep, end=end, file=file, flush=flush)
@@ -1,7 +1,12 @@
 from enum import IntEnum
+from collections.abc import Mapping
 from . import db
+from . import util
 from .loader import loader as loader
+import array
 import datetime
+import math
+import sys
 
 class JobStatus(IntEnum):
     unlinked = -4
@@ -9,8 +14,12 @@ class JobStatus(IntEnum):
     ready = -2
     running = -1
     exit_success = 0
+    timeout = -5
+    cancelled = -6
 
 class AbsoluteMetric:
+    __slots__ = ("type", "reference", "tolerance", "unit")
+    series = False
     def __init__(self, reference, tolerance, unit = None):
         self.type = "absolute"
         self.reference = reference
@@ -20,95 +29,364 @@ class AbsoluteMetric:
         return abs(value - self.reference)
     def within_tolerance(self, value):
         return self.distance(value) <= self.tolerance
+    @staticmethod
+    def distances(np, values, references):
+        """distance of many values at once (numpy arrays)"""
+        return np.abs(values - references)
 
 class RelativeMetric:
+    __slots__ = ("type", "reference", "tolerance")
+    series = False
     def __init__(self, reference, tolerance):
         self.type = "relative"
         self.reference = reference
         self.tolerance = tolerance
     def distance(self, value):
-        return (abs(value - self.reference) / self.reference)
+        if self.reference == 0:
+            # only 0 is close to 0
+            return 0. if value == 0 else math.inf
+        return abs(value - self.reference) / abs(self.reference)
     def within_tolerance(self, value):
+        # False for NaN
         return self.distance(value) <= self.tolerance
+    @staticmethod
+    def distances(np, values, references):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d = np.abs(values - references) / np.abs(references)
+        zero = references == 0
+        d[zero] = np.where(values[zero] == 0, 0., np.inf)
+        return d
+
+def percentile(values, p):
+    """p-th percentile of values, interpolated linearly (as numpy.percentile)"""
+    s = sorted(values)
+    k = (len(s) - 1) * p / 100
+    i = math.floor(k)
+    j = min(i + 1, len(s) - 1)
+    return s[i] + (s[j] - s[i]) * (k - i)
+
+def _as_series(value):
+    return value if isinstance(value, (list, tuple, array.array)) else [value]
+
+def _differences(values, reference):
+    """absolute element-wise differences, None if the lengths differ"""
+    values = _as_series(values)
+    if len(values) != len(reference):
+        return None
+    return [abs(v - r) for v, r in zip(values, reference)]
+
+class MaxNormMetric:
+    """Series compared element-wise with a reference series : largest absolute difference."""
+    __slots__ = ("type", "reference", "tolerance")
+    series = True
+    def __init__(self, reference, tolerance):
+        self.type = "max-norm"
+        self.reference = _as_series(reference)
+        self.tolerance = float(tolerance)
+    def distance(self, values):
+        d = _differences(values, self.reference)
+        if d is None:
+            return math.inf
+        # NaN if any difference is NaN
+        return max(d, default=0.) if not math.isnan(math.fsum(d)) else math.nan
+    def within_tolerance(self, values):
+        return self.distance(values) <= self.tolerance
+
+class L2RelativeMetric:
+    """Series compared with a reference series : ||values - reference|| / ||reference||."""
+    __slots__ = ("type", "reference", "tolerance")
+    series = True
+    def __init__(self, reference, tolerance):
+        self.type = "l2-relative"
+        self.reference = _as_series(reference)
+        self.tolerance = float(tolerance)
+    def distance(self, values):
+        d = _differences(values, self.reference)
+        if d is None:
+            return math.inf
+        norm = math.hypot(*self.reference)
+        if norm == 0:
+            return 0. if math.hypot(*d) == 0 else math.inf
+        return math.hypot(*d) / norm
+    def within_tolerance(self, values):
+        return self.distance(values) <= self.tolerance
+
+class PercentileMetric:
+    """
+    Repetitions of a measure, typically timings. The distance is relative, from the
+    reference to the band between the percentiles of the values : 0 if the
+    reference is in the band. Less than repetitions values do not pass.
+    """
+    __slots__ = ("type", "reference", "tolerance", "percentiles", "repetitions")
+    series = True
+    parameters = ("percentiles", "repetitions")
+    def __init__(self, reference, tolerance, percentiles=(50, 50), repetitions=1):
+        self.type = "percentile"
+        self.reference = reference
+        self.tolerance = float(tolerance)
+        self.percentiles = tuple(percentiles)
+        self.repetitions = int(repetitions)
+    def distance(self, values):
+        values = _as_series(values)
+        if len(values) < max(self.repetitions, 1):
+            return math.inf
+        if any(math.isnan(v) for v in values):
+            return math.nan
+        low, high = (percentile(values, p) for p in self.percentiles)
+        gap = max(low - self.reference, self.reference - high, 0.)
+        if self.reference == 0:
+            return 0. if gap == 0 else math.inf
+        return gap / abs(self.reference)
+    def within_tolerance(self, values):
+        return self.distance(values) <= self.tolerance
+
+# Metric types by name. A new type provides distance and within_tolerance,
+# parameters (names of its optional arguments, given in the yaml file) if any,
+# and either distances (see evaluate_metrics) or series = True : its values and
+# its reference may be series, it is evaluated one metric at a time.
+metric_types = {"relative" : RelativeMetric, "absolute" : AbsoluteMetric, "max-norm" : MaxNormMetric,
+                "l2-relative" : L2RelativeMetric, "percentile" : PercentileMetric}
+
+def metric_code(metric_type):
+    """type code of the metrics in a MetricTable"""
+    return list(metric_types).index(metric_type)
+
+class MetricTable:
+    """
+    Expected metrics of every validation of a run, one row per metric, in columns.
+    A Validation owns the rows [start, stop). numpy.asarray uses the columns without copy.
+    distance and passed are filled by evaluate, only for the rows changed since its last call.
+    Series (recorded or references) and parameters of a metric are kept aside, by row.
+    """
+    __slots__ = ("metric", "type", "reference", "tolerance", "value", "recorded", "distance", "passed",
+                 "dirty_from", "series", "params")
+    def __init__(self):
+        self.metric = [] # interned ids
+        self.type = array.array("b") # see metric_code
+        self.reference = array.array("d")
+        self.tolerance = array.array("d")
+        self.value = array.array("d") # NaN if not recorded, mean of a series
+        self.recorded = array.array("b")
+        self.distance = array.array("d")
+        self.passed = array.array("b")
+        self.dirty_from = 0
+        self.series = {} # recorded series
+        self.params = {} # reference series and parameters (as in the yaml file)
+
+    def __len__(self):
+        return len(self.metric)
+
+    def append(self, metric_id, metric_type, reference, tolerance, params=None):
+        if params:
+            self.params[len(self)] = params
+        if isinstance(reference, (list, tuple)):
+            self.params[len(self)] = {**(params or {}), "reference" : array.array("d", reference)}
+            reference = math.nan
+        self.metric.append(sys.intern(metric_id))
+        self.type.append(metric_code(metric_type))
+        self.reference.append(float(reference))
+        self.tolerance.append(float(tolerance))
+        self.value.append(math.nan)
+        self.recorded.append(0)
+
+    def record(self, row, value):
+        """value is None if the metric was not recorded"""
+        self.recorded[row] = value is not None
+        self.series.pop(row, None)
+        if isinstance(value, (list, tuple, array.array)):
+            self.series[row] = value
+            value = math.fsum(value) / len(value) if len(value) else math.nan
+        self.value[row] = value if value is not None else math.nan
+        self.dirty_from = min(self.dirty_from, row)
+
+    def recorded_value(self, row):
+        """recorded series, or value"""
+        return self.series.get(row, self.value[row])
+
+    def get_metric(self, row):
+        """Metric object (see metric_types) of a row"""
+        cls = list(metric_types.values())[self.type[row]]
+        params = dict(self.params.get(row, ()))
+        reference = params.pop("reference", self.reference[row])
+        return cls(reference, self.tolerance[row], **params)
+
+    def evaluate(self):
+        start = min(self.dirty_from, len(self.distance))
+        if start == len(self):
+            return
+        distance, passed = evaluate_metrics(self, start, len(self))
+        del self.distance[start:]
+        del self.passed[start:]
+        self.distance.extend(distance)
+        self.passed.extend(passed)
+        self.dirty_from = len(self)
+
+def evaluate_metrics(table, start, stop):
+    """
+    Distances and pass mask of the rows [start, stop) of a MetricTable, as arrays.
+    Metrics not recorded, NaN values and NaN references do not pass.
+    All rows are evaluated at once with numpy if it is available, one by one otherwise.
+    """
+    np = util.numpy_module()
+    if np is None:
+        distance = array.array("d")
+        passed = array.array("b")
+        for row in range(start, stop):
+            if table.recorded[row]:
+                metric = table.get_metric(row)
+                # other types compare the mean of a series, as with numpy
+                d = metric.distance(table.recorded_value(row) if metric.series else table.value[row])
+            else:
+                d = math.nan
+            distance.append(d)
+            passed.append(d <= table.tolerance[row])
+        return distance, passed
+    values = np.frombuffer(table.value, dtype=np.float64)[start:stop]
+    references = np.frombuffer(table.reference, dtype=np.float64)[start:stop]
+    types = np.frombuffer(table.type, dtype=np.int8)[start:stop]
+    distance = np.full(stop - start, np.nan)
+    for code, cls in enumerate(metric_types.values()):
+        mask = types == code
+        if not mask.any():
+            continue
+        if cls.series:
+            distance[mask] = [table.get_metric(row).distance(table.recorded_value(row))
+                              for row in np.flatnonzero(mask) + start]
+        else:
+            distance[mask] = cls.distances(np, values[mask], references[mask])
+    recorded = np.frombuffer(table.recorded, dtype=np.int8)[start:stop].astype(bool)
+    distance[~recorded] = np.nan
+    with np.errstate(invalid="ignore"):
+        passed = distance <= np.frombuffer(table.tolerance, dtype=np.float64)[start:stop]
+    # the buffers of the table are released, it can grow again
+    return array.array("d", distance.tobytes()), array.array("b", passed.astype(np.int8).tobytes())
+
+def hr_usage(usage):
+    """Human readable resource usage (dict with the keys db.usage_columns), "" if not measured"""
+    if not usage:
+        return ""
+    u = usage
+    return (f"CPU {u['user_time']:.2f}s user + {u['system_time']:.2f}s sys, max RSS {u['max_rss']/2**20:.1f} MiB, "
+            f"{u['voluntary_switches']}/{u['involuntary_switches']} ctx switches (vol/invol), "
+            f"I/O {u['read_bytes']/2**20:.1f}/{u['write_bytes']/2**20:.1f} MiB (read/write)")
+
+class Verdict:
+    """Evaluation of a step, computed once and kept until its status or metrics change."""
+    __slots__ = ("success", "failures", "missing", "out_of_tolerance")
+    def __init__(self, success, failures, missing=frozenset(), out_of_tolerance=()):
+        self.success = success
+        self.failures = failures
+        self.missing = missing
+        self.out_of_tolerance = out_of_tolerance
 
 class Validation:
+    __slots__ = ("Task", "_verdict", "raw_dict", "status", "executable", "type", "launch_command",
+                 "table", "start", "stop", "untracked", "start_date", "end_date", "usage")
     default_type = "relative"
     default_reference = None
-    def __init__(self, valid_dict, config, task=None):
+    def __init__(self, valid_dict, config, task=None, table=None):
+        self.Task = task
+        self._verdict = None
         self.raw_dict = valid_dict
         self.status = JobStatus.unlinked
         self.executable = valid_dict["executable"]
         self.type = valid_dict["type"]
         self.launch_command = valid_dict["launch_command"]
-        self.recorded_metrics = {}
+        self.table = table if table is not None else MetricTable()
+        self.untracked = None # recorded metrics which are not expected
         self.init_metrics(config)
         self.start_date = None
         self.end_date = None
-        self.Task = task
+        self.usage = None
+
+    def invalidate(self):
+        self._verdict = None
+        if self.Task is not None:
+            self.Task.invalidate()
+
+    def _rows(self):
+        return range(self.start, self.stop)
+
+    @property
+    def expected_metrics(self):
+        return {self.table.metric[i] : self.table.get_metric(i) for i in self._rows()}
+
+    @property
+    def recorded_metrics(self):
+        res = {self.table.metric[i] : self.table.recorded_value(i) for i in self._rows() if self.table.recorded[i]}
+        res.update(self.untracked or {})
+        return res
+
+    @recorded_metrics.setter
+    def recorded_metrics(self, metrics):
+        metrics = dict(metrics)
+        for i in self._rows():
+            self.table.record(i, metrics.pop(self.table.metric[i], None))
+        self.untracked = metrics or None
+        self.invalidate()
+
+    @property
+    def verdict(self):
+        if self._verdict is None:
+            table = self.table
+            # every metric changed since the last evaluation, not only ours
+            table.evaluate()
+            missing = set()
+            out_of_tolerance = []
+            for i in self._rows():
+                if not table.recorded[i]:
+                    missing.add(table.metric[i])
+                elif not table.passed[i]:
+                    out_of_tolerance.append((table.metric[i], table.get_metric(i), table.recorded_value(i)))
+            self._verdict = Verdict(not(missing or out_of_tolerance), (), missing or frozenset(), out_of_tolerance or ())
+        return self._verdict
 
     def init_metrics(self, config):
-        self.expected_metrics = {}
+        self.start = len(self.table)
         for metric in self.raw_dict.get("Metrics", []):
             t = metric.get("type", self.default_type)
-            if t not in ["relative", "absolute"]:
-                raise ValueError("'type' must be 'relative' or 'absolute'.")
-            #reference is either a dict or a number.
+            if t not in metric_types:
+                raise ValueError(f"'type' must be one of {', '.join(metric_types)}.")
+            params = {p : metric[p] for p in getattr(metric_types[t], "parameters", ()) if p in metric}
+            #reference is either a dict (by configuration), a number or a list (series).
             ref = metric.get("reference", self.default_reference)
             if ref is None:
                 raise ValueError("'reference' must be provided.")
             if isinstance(ref, dict):
                 if config in ref:
-                    if t == "relative":
-                        self.expected_metrics[metric["id"]] = RelativeMetric(ref[config], metric["tolerance"])
-                    else:
-                        self.expected_metrics[metric["id"]] = AbsoluteMetric(ref[config], metric["tolerance"])
+                    self.table.append(metric["id"], t, ref[config], metric["tolerance"], params)
             else:
-                if t == "relative":
-                    self.expected_metrics[metric["id"]] = RelativeMetric(ref, metric["tolerance"])
-                else:
-                    self.expected_metrics[metric["id"]] = AbsoluteMetric(ref, metric["tolerance"])
+                self.table.append(metric["id"], t, ref, metric["tolerance"], params)
+        self.stop = len(self.table)
 
     def get_missing_metrics(self):
-        e_m = set(self.expected_metrics.keys())
-        r_m = set(self.recorded_metrics.keys())
-        return e_m.difference(r_m)
+        return set(self.verdict.missing)
 
     def get_untracked_metrics(self):
-        e_m = set(self.expected_metrics.keys())
-        r_m = set(self.recorded_metrics.keys())
-        return {m : self.recorded_metrics[m] for m in r_m.difference(e_m)}
+        return dict(self.untracked or {})
 
     def get_out_of_tolerance_metrics(self):
-        res = []
-        for k,v in self.recorded_metrics.items():
-            if k in self.expected_metrics:
-                if not(self.expected_metrics[k].within_tolerance(v)):
-                    res.append((k, self.expected_metrics[k], v))
-        return res
+        return list(self.verdict.out_of_tolerance)
 
     @property
     def missing_metrics(self):
-        return bool(self.get_missing_metrics())
+        return bool(self.verdict.missing)
 
     @property
     def success(self):
-        if self.missing_metrics:
-            return False
-        for metric_id, metric in self.expected_metrics.items():
-            if not metric.within_tolerance(self.recorded_metrics[metric_id]):
-                return False
-        return True
+        return self.verdict.success
 
     @property
     def elapsed(self):
         return self.end_date-self.start_date
 
 class FileComparisonValidation(Validation):
+    __slots__ = ("base", "ref_id")
     default_type = "absolute"
     default_reference = 0
 
-    def __init__(self, valid_dict, config, task=None):
-        super().__init__(valid_dict, config, task)
+    def __init__(self, valid_dict, config, task=None, table=None):
+        super().__init__(valid_dict, config, task, table)
         self.base = self.raw_dict["base"]
         self.ref_id = self.raw_dict["ref"]
 
@@ -124,7 +402,11 @@ class FileComparisonValidation(Validation):
         return "" #The gcvb.db may be used alone, the filename information is lost in this case #FIXME
 
 class Task():
-    def __init__(self, task_dict, config, test=None):
+    __slots__ = ("Test", "_verdict", "raw_dict", "_status", "executable", "options", "launch_command",
+                 "nprocs", "nthreads", "Validations", "start_date", "_end_date", "usage")
+    def __init__(self, task_dict, config, test=None, table=None):
+        self.Test = test
+        self._verdict = None
         self.raw_dict = task_dict
         self.status = JobStatus.unlinked
         self.executable = task_dict["executable"]
@@ -136,34 +418,70 @@ class Task():
         self.Validations = []
         for v in task_dict.get("Validations", []):
             if v["type"] == "script":
-                self.Validations.append(Validation(v, config, self))
+                self.Validations.append(Validation(v, config, self, table))
             else:
-                self.Validations.append(FileComparisonValidation(v, config, self))
+                self.Validations.append(FileComparisonValidation(v, config, self, table))
         self.start_date = None
         self.end_date = None
-        self.Test = test
+        self.usage = None # measured by the jobrunner, see db.usage_columns
+
+    def invalidate(self):
+        self._verdict = None
+        if self.Test is not None:
+            self.Test.invalidate()
+
+    # the verdict depends on the status and on the completion
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+        self.invalidate()
+
+    @property
+    def end_date(self):
+        return self._end_date
+
+    @end_date.setter
+    def end_date(self, end_date):
+        self._end_date = end_date
+        self.invalidate()
 
     @property
     def completed(self):
         return bool(self.end_date)
 
+    @property
+    def verdict(self):
+        if self._verdict is None:
+            success = (self.completed and self.status == JobStatus.exit_success
+                       and all([v.success for v in self.Validations]))
+            self._verdict = Verdict(success, self._evaluate_failures())
+        return self._verdict
+
     @property
     def success(self):
-        if not self.completed:
-            return False
-        if self.status != JobStatus.exit_success:
-            return False
-        return all([v.success for v in self.Validations])
+        return self.verdict.success
 
     @property
     def elapsed(self):
+        """None if the task was not started (or copied from a task without start date)"""
+        if self.start_date is None or self.end_date is None:
+            return None
         return self.end_date-self.start_date
 
     def get_failures(self):
+        return list(self.verdict.failures)
+
+    def _evaluate_failures(self):
         res = []
         if self.completed:
             if self.status > JobStatus.exit_success:
                 res.append(ExitFailure(self.executable, self.status))
+            if self.status in (JobStatus.timeout, JobStatus.cancelled):
+                res.append(StoppedFailure(self.executable, self.status))
             # Missing metric is a failure only if the task is completed
             for v in self.Validations:
                 missing = v.get_missing_metrics()
@@ -177,23 +495,36 @@ class Task():
 
     def hr_result(self):
         # returns a string representing the first failure
-        f = self.get_failures()
+        f = self.verdict.failures
         if f:
             return f[0].hr_result()
         return "Success"
 
     def hr_elapsed(self):
         if self.completed:
-            return str(self.elapsed)
+            return str(self.elapsed) if self.elapsed is not None else "N/A"
         return "DNF" #Did not finish
 
+    @property
+    def cpu_time(self):
+        """User + system time in seconds, None if not measured."""
+        if not self.usage:
+            return None
+        return self.usage["user_time"] + self.usage["system_time"]
+
+    def hr_usage(self):
+        return hr_usage(self.usage)
+
 class Test():
+    __slots__ = ("_failures", "raw_dict", "Tasks", "Steps", "name", "start_date", "end_date", "data", "Run")
     def __init__(self, test_dict, config, name=None, start_date=None, end_date=None, run=None):
+        self._failures = None
         self.raw_dict = test_dict
-        # Tasks
+        # Tasks, their metrics are stored in the table of the run
+        table = run.metrics if run is not None else MetricTable()
         self.Tasks = []
         for t in test_dict.get("Tasks"):
-            self.Tasks.append(Task(t, config, self))
+            self.Tasks.append(Task(t, config, self, table))
         # Steps
         self.Steps = []
         for t in self.Tasks:
@@ -212,6 +543,9 @@ class Test():
     def completed(self):
         return bool(self.end_date)
 
+    def invalidate(self):
+        self._failures = None
+
     @property
     def success(self):
         return all([t.success for t in self.Tasks])
@@ -219,7 +553,7 @@ class Test():
     @property
     def failed(self):
         #failed if a completed task failed.
-        return any([bool(t.get_failures()) for t in self.Tasks if t.completed])
+        return any([bool(t.verdict.failures) for t in self.Tasks if t.completed])
 
     @property
     def elapsed(self):
@@ -229,7 +563,9 @@ class Test():
         return f"{{id : {self.name}, status : TODO}}"
 
     def get_failures(self):
-        return [t.get_failures() for t in self.Tasks]
+        if self._failures is None:
+            self._failures = [t.verdict.failures for t in self.Tasks]
+        return self._failures
 
     def hr_result(self):
         if not(self.completed):
@@ -243,10 +579,15 @@ class Test():
     def cpu_time(self):
         ct = 0
         for task in self.Tasks:
-            if task.completed:
+            if not task.completed:
+                return float('inf')
+            if task.cpu_time is not None:
+                ct += task.cpu_time
+            elif task.elapsed is not None:
+                # not run by a jobrunner, estimated
                 ct += task.elapsed.total_seconds() * task.nthreads * task.nprocs
             else:
-                return float('inf')
+                return None
         return ct
 
 def _strtotimestamp(s):
@@ -256,24 +597,65 @@ def _strtotimestamp(s):
     else:
         return s
 
+class _LazyTests(Mapping):
+    """Tests of a run by name. A Test is only built when it is accessed, the
+       steps of all tests are loaded at once when every test is needed."""
+    __slots__ = ("run", "db_tests", "built", "all_built")
+    def __init__(self, run):
+        self.run = run
+        self.db_tests = {t["name"] : t for t in db.get_tests(run.run_id)}
+        self.built = {}
+        self.all_built = False
+
+    def __len__(self):
+        return len(self.db_tests)
+
+    def __iter__(self):
+        return iter(self.db_tests)
+
+    def __contains__(self, name):
+        return name in self.db_tests
+
+    def __getitem__(self, name):
+        if name not in self.built:
+            db_test = self.db_tests[name]
+            self.built[name] = self.run._build_test(db_test, db.load_report_n(self.run.run_id, name)[name],
+                                                    db.get_steps(self.run.run_id, name)[name])
+        return self.built[name]
+
+    def build_all(self):
+        if self.all_built:
+            return
+        recorded_metrics = db.load_report_n(self.run.run_id)
+        steps = db.get_steps(self.run.run_id)
+        self.built = {name : self.built.get(name) or self.run._build_test(t, recorded_metrics[name], steps[name])
+                      for name, t in self.db_tests.items()}
+        self.all_built = True
+
+    def values(self):
+        self.build_all()
+        return self.built.values()
+
+    def items(self):
+        self.build_all()
+        return self.built.items()
+
 class Run():
-    def __test_db_to_objects(self):
-        self.db_tests = db.get_tests(self.run_id)
-        self.base_id = db.get_base_from_run(self.run_id)
-        self.gcvb_base = loader.load_base(self.run_id)
-        self.references = loader.references
-        b = self.gcvb_base["Tests"]
-        self.Tests = {t["name"] : Test(b[t["name"]], self.config, t["name"], t["start_date"], t["end_date"], self) for t in self.db_tests}
+    __slots__ = ("run_id", "start_date", "end_date", "config", "gcvb_id", "base_id", "Tests", "db_tests",
+                 "metrics", "__gcvb_base", "__summary")
+    def _build_test(self, db_test, recorded_metrics, steps):
+        test = Test(self.gcvb_base["Tests"][db_test["name"]], self.config, db_test["name"],
+                    db_test["start_date"], db_test["end_date"], self)
         # Fill infos for every step
-        recorded_metrics = db.load_report_n(self.run_id)
-        steps = db.get_steps(self.run_id)
-        for test_id, test in self.Tests.items():
-            for step, metrics in recorded_metrics[test_id].items():
-                test.Steps[step-1].recorded_metrics = metrics
-            for step, step_info in steps[test_id].items():
-                test.Steps[step-1].start_date = _strtotimestamp(step_info["start_date"])
-                test.Steps[step-1].end_date = _strtotimestamp(step_info["end_date"])
-                test.Steps[step-1].status = step_info["status"]
+        for step, metrics in recorded_metrics.items():
+            test.Steps[step-1].recorded_metrics = metrics
+        for step, step_info in steps.items():
+            test.Steps[step-1].start_date = _strtotimestamp(step_info["start_date"])
+            test.Steps[step-1].end_date = _strtotimestamp(step_info["end_date"])
+            test.Steps[step-1].status = step_info["status"]
+            if step_info["user_time"] is not None:
+                test.Steps[step-1].usage = {c : step_info[c] for c in db.usage_columns}
+        return test
 
     def __init__(self, run_id):
         self.run_id = run_id
@@ -283,8 +665,32 @@ class Run():
         self.end_date = run_infos["end_date"]
         self.config = run_infos["config_id"]
         self.gcvb_id = run_infos["gcvb_id"]
+        self.base_id = self.gcvb_id
+
+        # Tests are built when accessed (the base is loaded then)
+        self.metrics = MetricTable()
+        self.Tests = _LazyTests(self)
+        self.db_tests = list(self.Tests.db_tests.values())
+        self.__gcvb_base = None
+        self.__summary = None
+
+    @property
+    def gcvb_base(self):
+        if self.__gcvb_base is None:
+            self.__gcvb_base = loader.load_base(self.run_id)
+        return self.__gcvb_base
+
+    @property
+    def references(self):
+        self.gcvb_base
+        return loader.references
 
-        self.__test_db_to_objects()
+    @property
+    def summary(self):
+        """Counts and resource usage computed by the database (see db.get_run_summary)."""
+        if self.__summary is None:
+            self.__summary = db.get_run_summary(self.run_id)
+        return self.__summary
 
     @property
     def completed(self):
@@ -292,6 +698,9 @@ class Run():
 
     @property
     def success(self):
+        # a task not completed is not a success, no need to look at the metrics
+        if self.summary["completed_tasks"] < self.summary["tasks"]:
+            return False
         return all([test.success for test in self.Tests.values()])
 
     @property
@@ -302,8 +711,15 @@ class Run():
     def elapsed(self):
         return self.end_date-self.start_date
 
+    def resource_usage(self):
+        """Sum of the resource usage measured for all steps (maximum for max_rss)."""
+        return self.summary["usage"] or {}
+
+    def hr_usage(self):
+        return hr_usage(self.resource_usage())
+
     def get_running_tests(self):
-        return [k for k,v in self.Tests.items() if not v.completed]
+        return [t["name"] for t in self.db_tests if not t["end_date"]]
 
     def get_failures(self):
         return {test_id : test.get_failures() for test_id, test in self.Tests.items() if any(test.get_failures())}
@@ -318,6 +734,7 @@ class Run():
 
 
 class TaskFailure():
+    __slots__ = ()
     def __init__(self):
         pass
 
@@ -328,6 +745,7 @@ class TaskFailure():
         pass
 
 class ExitFailure(TaskFailure):
+    __slots__ = ("executable", "return_code")
     def __init__(self, executable, return_code):
         self.executable = executable
         self.return_code = return_code
@@ -342,7 +760,25 @@ class ExitFailure(TaskFailure):
         return f"{self.executable} exited with code {self.return_code}"
 
 
+class StoppedFailure(TaskFailure):
+    __slots__ = ("executable", "status")
+    def __init__(self, executable, status):
+        self.executable = executable
+        self.status = JobStatus(status)
+
+    def __repr__(self):
+        return f"<Stopped ({self.status.name})>"
+
+    def __str__(self):
+        return self.__repr__()
+
+    def hr_result(self):
+        if self.status == JobStatus.timeout:
+            return f"{self.executable} was killed after its timeout"
+        return f"{self.executable} was cancelled"
+
 class MissingMetric(TaskFailure):
+    __slots__ = ("metric_id",)
     def __init__(self, metric_id):
         self.metric_id = metric_id
 
@@ -356,6 +792,7 @@ class MissingMetric(TaskFailure):
         return f"Metric {self.metric_id} is missing."
 
 class OutOfTolerance(TaskFailure):
+    __slots__ = ("metric_id", "metric", "recorded")
     def __init__(self, metric_id, metric, recorded):
         self.metric_id = metric_id
         self.metric = metric
@@ -10,7 +10,7 @@ _HTML_TEMPLATE="""
 <li>Number of completed tests: {num_compl}</li>
 <li>Number of failure: {num_failure}</li>
 <li>Start date: {start}</li>
-<li>End date: {end}</li>
+<li>End date: {end}</li>{usage}
 </ul>
 <h2>Failed tests</h2>
 <ul>"""
@@ -23,6 +23,7 @@ def html_report(run):
     num_failure = len(failures)
     start = run.start_date
     end = run.end_date
+    usage = f"\n<li>Resource usage: {run.hr_usage()}</li>" if run.resource_usage() else ""
     strfailures = []
     for testid in sorted(run.Tests.keys()):
         t = run.Tests[testid]
@@ -45,4 +46,6 @@ def str_report(run):
         res += f"Failure : {len(run.get_failures())} failed.\n\n"
         res += "Details of failures :\n"
         res += pformat(run.get_failures())
+    if run.resource_usage():
+        res += f"\nResource usage : {run.hr_usage()}"
     return res
@@ -0,0 +1,183 @@
+import bisect
+import heapq
+import importlib
+import os
+import statistics
+from . import db
+from . import jobrunner
+from . import yaml_input
+
+class Policy(object):
+    """
+    Choose the next job to run among the ready ones.
+
+    runner is a JobRunner or a Simulation. Both expose run_id, tests, children,
+    available_cores, running_tests (running jobs indexed by (test name, step))
+    and clock(). Running jobs have a start_time given by clock().
+    """
+    def prepare(self, runner):
+        """Called once before the first election."""
+        pass
+
+    def elect(self, runner, queue):
+        """
+        Returns the job to run, or None to wait for a running job to complete.
+
+        queue -- iterable of available jobs
+        """
+        raise NotImplementedError
+
+class CoresPolicy(Policy):
+    """Largest job that fits first, to avoid starvation at the end."""
+    def elect(self, runner, queue):
+        queue = sorted(queue, key = lambda x: x.num_cores())
+        if len(runner.running_tests) == 0:
+            # begin with a small job to detect errors early
+            return queue[0] if len(queue) else None
+        else:
+            # fill large jobs first to avoid starvation at the end
+            i = bisect.bisect([x.num_cores() for x in queue], runner.available_cores) - 1
+            return queue[i] if i >= 0 else None
+
+def expected_durations(before_run=None):
+    """Median duration of successful tasks by (test name, step), in the runs before before_run.
+       The median of all of them is used for unknown tasks."""
+    last_run = before_run - 1 if before_run is not None else None
+    history = {}
+    for t in db.get_task_durations(last_run=last_run):
+        if t["status"] == 0 and t["duration"] is not None:
+            history.setdefault((t["name"], t["step"]), []).append(t["duration"])
+    durations = {k : statistics.median(v) for k, v in history.items()}
+    default = statistics.median(durations.values()) if durations else 1.
+    return durations, default
+
+class PriorityPolicy(Policy):
+    """Job with the highest priority among those that fit. Priorities are
+       computed from the expected durations (see expected_durations)."""
+    def prepare(self, runner):
+        self.durations, self.default = expected_durations(runner.run_id)
+
+    def duration(self, job):
+        return self.durations.get((job.test_id, job.step), self.default)
+
+    def priority(self, job):
+        raise NotImplementedError
+
+    def elect(self, runner, queue):
+        fitting = [j for j in queue if j.num_cores() <= runner.available_cores]
+        if not fitting:
+            # a job larger than the runner is started alone
+            return min(queue, key = lambda x: x.num_cores()) if queue and not runner.running_tests else None
+        return max(fitting, key = lambda x: (self.priority(x), x.num_cores()))
+
+class LPTPolicy(PriorityPolicy):
+    """Longest processing time first."""
+    def priority(self, job):
+        return self.duration(job)
+
+class CriticalPathPolicy(PriorityPolicy):
+    """Job with the longest chain of remaining steps (itself included) first."""
+    def prepare(self, runner):
+        super().prepare(runner)
+        self.bottom = {}
+        for test, tasks in runner.tests.items():
+            # children always have a larger step than their parent
+            for step in sorted(tasks, reverse=True):
+                children = runner.children.get((test, step), [])
+                self.bottom[(test, step)] = self.duration(tasks[step]) + max(
+                    (self.bottom[(test, c)] for c in children), default=0.)
+
+    def priority(self, job):
+        return self.bottom[(job.test_id, job.step)]
+
+class BackfillPolicy(CriticalPathPolicy):
+    """
+    The job on the critical path is started first. If it does not fit, cores are
+    reserved for it and smaller jobs are only started if they do not delay it
+    (EASY backfilling).
+    """
+    def elect(self, runner, queue):
+        if not queue:
+            return None
+        head = max(queue, key = lambda x: (self.priority(x), x.num_cores()))
+        if head.num_cores() <= runner.available_cores or not runner.running_tests:
+            return head
+        # Time when enough cores are released for head, and cores left then.
+        now = runner.clock()
+        free = runner.available_cores
+        shadow = now
+        for end, cores in sorted((j.start_time + self.duration(j), j.num_cores()) for j in runner.running_tests.values()):
+            free += cores
+            shadow = max(end, now)
+            if free >= head.num_cores():
+                break
+        extra = free - head.num_cores()
+        backfill = [j for j in queue if j.num_cores() <= runner.available_cores
+                    and (now + self.duration(j) <= shadow or j.num_cores() <= extra)]
+        return max(backfill, key = lambda x: (self.priority(x), x.num_cores())) if backfill else None
+
+policies = {
+    "cores" : CoresPolicy,
+    "lpt" : LPTPolicy,
+    "critical-path" : CriticalPathPolicy,
+    "backfill" : BackfillPolicy,
+}
+
+def get_policy(name):
+    """Returns a policy from its name, or from a "module.Class" path for custom policies."""
+    if name in policies:
+        return policies[name]()
+    module, _, cls = name.rpartition(".")
+    if not module:
+        raise ValueError(f"Unknown scheduling policy '{name}'. Available : {', '.join(policies)}.")
+    return getattr(importlib.import_module(module), cls)()
+
+class Simulation(object):
+    """Replays the task graph of a run with the durations recorded in the database."""
+    def __init__(self, run_id, num_cores, config):
+        self.run_id = run_id
+        self.num_cores = num_cores
+        base = db.get_base_from_run(run_id)
+        test_yaml = yaml_input.load_yaml(os.path.join(f"./results/{base}", "tests.yaml"))
+        self.tests, _ = jobrunner.load_jobs(run_id, config, test_yaml)
+        self.children, _ = jobrunner.load_children(run_id)
+        self.durations = {(t["name"], t["step"]) : t["duration"]
+                          for t in db.get_task_durations(run_id, run_id) if t["duration"] is not None}
+
+    def clock(self):
+        return self.now
+
+    def makespan(self, policy):
+        """Returns the simulated duration of the run (in seconds) with policy."""
+        self.now = 0.
+        self.available_cores = self.num_cores
+        self.running_tests = {}
+        policy.prepare(self)
+        # tasks which were not run are assumed to last as expected by the policy, or 0.
+        expected = getattr(policy, "duration", lambda j: 0.)
+        ready = {(test, step) for test, tasks in self.tests.items() for step in tasks}
+        # first steps have 0 as parent
+        ready -= {(test, c) for (test, parent), children in self.children.items()
+                  if parent in self.tests[test] for c in children}
+        events = []
+        while True:
+            job = policy.elect(self, [self.tests[t][s] for t, s in ready]) if ready else None
+            if job is not None:
+                key = (job.test_id, job.step)
+                ready.discard(key)
+                job.start_time = self.now
+                self.available_cores -= job.num_cores()
+                self.running_tests[key] = job
+                heapq.heappush(events, (self.now + self.durations.get(key, expected(job)), key))
+                continue
+            if not events:
+                return self.now
+            self.now, key = heapq.heappop(events)
+            job = self.running_tests.pop(key)
+            self.available_cores += job.num_cores()
+            ready.update((job.test_id, c) for c in self.children.get(key, []))
+
+def simulate(run_id, num_cores, config, names=None):
+    """Returns the simulated makespan of run_id for each policy name."""
+    simulation = Simulation(run_id, num_cores, config)
+    return {name : simulation.makespan(get_policy(name)) for name in names or policies}
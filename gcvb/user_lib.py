@@ -1,15 +1,113 @@
 from . import db
+import array
 import os
+import json
 
-def add_metric(name, value):
-    db.set_db("../../../gcvb.db")
+def _get_step_infos():
     for env in ["GCVB_RUN_ID","GCVB_TEST_ID","GCVB_STEP_ID"]:
         if env not in os.environ:
             raise Exception("Environment variable {} is not defined.".format(env))
     test_id=os.environ["GCVB_TEST_ID"] # string as in the yaml file.
     run_id=os.environ["GCVB_RUN_ID"] # integer id
     step_id=os.environ["GCVB_STEP_ID"]
-    db.add_metric(run_id, test_id, step_id, name, value)
+    return run_id, test_id, step_id
+
+def _spool_only():
+    # jobs of a distributed.Worker : the coordinator owns the database
+    return os.environ.get("GCVB_SPOOL_METRICS") == "1"
+
+def add_metric(name, value):
+    if _spool_only():
+        with MetricSession(spool=True) as s:
+            s.add_metric(name, value)
+        return
+    db.set_db("../../../gcvb.db")
+    run_id, test_id, step_id = _get_step_infos()
+    db.add_metric(run_id, test_id, step_id, name, _value(value))
+
+def add_series(name, values):
+    """Record a series of values (convergence curve, timings of repetitions...)
+       as a single metric. See the series metric types of model.metric_types."""
+    add_metric(name, _series(values))
+
+def _series(values):
+    # list of float, JSON serializable (journal, spool)
+    return [float(v) for v in values]
+
+def _value(value):
+    """float, or list of float for a series (list, tuple or array.array, as in db)"""
+    return _series(value) if isinstance(value, (list, tuple, array.array)) else float(value)
+
+def add_metrics(metrics):
+    """Record several metrics in a single transaction.
+
+    Keyword arguments:
+    metrics -- dict {name : value}, value is a number or a list of numbers (series)
+    """
+    if _spool_only():
+        with MetricSession(spool=True) as s:
+            s.add_metrics(metrics)
+        return
+    db.set_db("../../../gcvb.db")
+    run_id, test_id, step_id = _get_step_infos()
+    db.add_metrics(run_id, test_id, step_id, [(name, _value(value)) for name, value in metrics.items()])
+
+def spool_path(step, test_dir="."):
+    """Path of the file where metrics of a step are spooled"""
+    return os.path.join(test_dir, f".gcvb_metrics_{step}")
+
+def read_spool(filename):
+    """Return the list of (name, value) spooled in filename (empty if it does not exist)"""
+    if not os.path.exists(filename):
+        return []
+    with open(filename, "r") as f:
+        return [tuple(json.loads(line)) for line in f if line.strip()]
+
+class MetricSession:
+    """Buffer metrics and record them all at once when the session ends.
+
+    with user_lib.MetricSession() as s:
+        for i, r in enumerate(residuals):
+            s.add_metric(f"residual_{i}", r)
+
+    Keyword arguments:
+    spool -- if True, metrics are appended to a file of the test directory
+             instead of being written in the database. gcvb records them
+             when the step ends, so the database is not locked at all by the
+             validation script.
+    """
+    def __init__(self, spool=False):
+        self.spool = spool
+        self.metrics = {}
+
+    def add_metric(self, name, value):
+        self.metrics[name] = value
+
+    def add_metrics(self, metrics):
+        self.metrics.update(metrics)
+
+    def add_series(self, name, values):
+        self.metrics[name] = _series(values)
+
+    def flush(self):
+        if not self.metrics:
+            return
+        if self.spool:
+            step_id = _get_step_infos()[2]
+            with open(spool_path(step_id), "a") as f:
+                for name, value in self.metrics.items():
+                    f.write(json.dumps([name, _value(value)]) + "\n")
+        else:
+            add_metrics(self.metrics)
+        self.metrics = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # metrics recorded before an error are still kept
+        self.flush()
+        return False
 
 def get_tests(run=None):
     if not(run):
@@ -24,4 +122,4 @@ def get_file_list(test, run=None):
 def retrieve_file(test, filename, run=None):
     if not(run):
         run=db.get_last_run()[0]
-    return db.retrieve_file(run, test, filename)
\ No newline at end of file
+    return db.retrieve_file(run, test, filename)
@@ -12,10 +12,11 @@ import pickle
 import re
 
 def hash_file(filename):
+    h = hashlib.sha256()
     with open(filename,"rb") as f:
-        b = f.read() # read entire file as bytes
-        readable_hash = hashlib.sha256(b).hexdigest()
-        return readable_hash
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
 def pickle_obj_to_binary(obj):
     """ return bytes from a python object"""
@@ -49,6 +50,75 @@ def file_to_compressed_binary(file_in):
         content = f.read()
     return gzip.compress(content)
 
+CHUNK_SIZE = 1 << 20
+
+# extension of the compressed files for each supported codec
+codecs = {"gzip" : ".gz", "zstd" : ".zst"}
+
+def zstandard_module():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the 'zstandard' package (pip install gcvb[zstd])")
+    return zstandard
+
+def numpy_module():
+    """numpy, or None if it is not installed (pip install gcvb[numpy])"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def open_compressed(fileobj, mode, codec="gzip", level=None):
+    """Return a file object (de)compressing to/from the binary file object fileobj.
+       Closing it does not close fileobj.
+
+    Keyword arguments:
+    mode  -- "rb" or "wb"
+    codec -- one of codecs
+    level -- compression level (default depends on the codec)
+    """
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode=mode, compresslevel=level if level is not None else 9)
+    if codec == "zstd":
+        zstandard = zstandard_module()
+        if mode == "rb":
+            return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+        cctx = zstandard.ZstdCompressor(level=level if level is not None else 3)
+        return cctx.stream_writer(fileobj, closefd=False)
+    raise ValueError(f"Unknown compression codec '{codec}'. Available : {', '.join(codecs)}")
+
+def compress_file(file_in, file_out, codec="gzip", level=None):
+    """Compress file_in into file_out chunk by chunk, memory usage does not depend on the file size."""
+    with open(file_in, "rb") as f_in, open(file_out, "wb") as f_out:
+        with open_compressed(f_out, "wb", codec, level) as f_c:
+            shutil.copyfileobj(f_in, f_c, CHUNK_SIZE)
+
+class DecompressedReader(io.RawIOBase):
+    """Read-only stream of the decompressed content of fileobj.
+       fileobj is closed with the stream."""
+    def __init__(self, fileobj, codec="gzip"):
+        self.fileobj = fileobj
+        self.stream = open_compressed(fileobj, "rb", codec)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+            self.fileobj.close()
+        super().close()
+
+def open_decompressed(fileobj, codec="gzip"):
+    return io.BufferedReader(DecompressedReader(fileobj, codec), CHUNK_SIZE)
+
 def str_to_ip(str_in, default_ip="127.0.0.1", default_port=8050):
     ip=default_ip
     port=default_port
@@ -75,4 +145,42 @@ def str_to_ip(str_in, default_ip="127.0.0.1", default_port=8050):
     max_value = (2**16-1)
     if port < 1 or port > max_value :
         raise ValueError(f"Port should be between 1 and {max_value}")
-    return ip, port
\ No newline at end of file
+    return ip, port
+
+
+def parse_cpulist(cpulist):
+    """'0-3,8' -> [0, 1, 2, 3, 8] (format of /sys/devices/system/node/node*/cpulist)"""
+    cpus=[]
+    for r in cpulist.strip().split(","):
+        if r:
+            first,_,last=r.partition("-")
+            cpus.extend(range(int(first), int(last or first)+1))
+    return cpus
+
+def format_cpulist(cpus):
+    """[0, 1, 2, 3, 8] -> '0-3,8'"""
+    ranges=[]
+    for c in sorted(cpus):
+        if ranges and ranges[-1][1]==c-1:
+            ranges[-1][1]=c
+        else:
+            ranges.append([c,c])
+    return ",".join(f"{a}-{b}" if a!=b else f"{a}" for a,b in ranges)
+
+memory_units={"":1024**2, "K":1024, "M":1024**2, "G":1024**3, "T":1024**4}
+
+def parse_memory(memory):
+    """'4G' -> 4294967296. Numbers without unit are megabytes."""
+    m=re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)i?B?\s*", str(memory), re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Invalid memory size '{memory}' (expected e.g. 512M or 4G).")
+    return int(float(m.group(1))*memory_units[m.group(2).upper()])
+
+duration_units={"":1, "s":1, "m":60, "h":3600, "d":86400}
+
+def parse_duration(duration):
+    """'90', '90s', '30m', '2h' -> seconds"""
+    m=re.fullmatch(r"\s*([0-9.]+)\s*([smhd]?)\s*", str(duration), re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Invalid duration '{duration}' (expected e.g. 90, 30m or 2h).")
+    return float(m.group(1))*duration_units[m.group(2).lower()]
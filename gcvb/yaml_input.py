@@ -77,13 +77,16 @@ def load_yaml(yaml_file, modifier=None):
     Keyword arguments:
     yaml_file -- name of the file to load
     """
-    dbmtime, res = db.load_yaml_cache(yaml_file)
+    # in journal mode (job scripts) the database is not used, the file is parsed
+    journal = db.use_journal()
+    dbmtime, res = db.load_yaml_cache(yaml_file) if not journal else (-1, None)
     fe = os.path.exists(yaml_file)
     mtime = os.path.getmtime(yaml_file) if fe else 0
     if dbmtime < mtime:
         original = util.open_yaml(yaml_file)
         res = convert_yaml_to_gcvb_dict(original)
-        db.save_yaml_cache(mtime, yaml_file, res)
+        if not journal:
+            db.save_yaml_cache(mtime, yaml_file, res)
     if not fe:
         print("Warning: {} not found, using cache.".format(yaml_file))
 
@@ -25,5 +25,8 @@ setuptools.setup(
     },
     extras_require = {
         "dashboard":  ["dash-bootstrap-components", "dash-defer-js-import"],
+        "zstd": ["zstandard"],
+        "export": ["pyarrow"],
+        "numpy": ["numpy"],
     }
 )